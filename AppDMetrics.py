@@ -1,16 +1,48 @@
+import dataclasses
+import hashlib
 import json
 import logging
+import os
 import sys
 import time
 from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
+from typing import Callable, Optional
 
-from prometheus_client import Gauge
+from prometheus_client import REGISTRY
 
+from api.Result import Result
 from api.appd.AppDService import AppDService
+from api.appd.TrafficArchive import TrafficRecorder
+from metrics.DiscoveryCache import ApplicationInventory, DiscoveryCache
+from metrics.InternalMetrics import (
+    CYCLE_PHASE_DURATION,
+    DEADLINE_SKIPPED_REQUESTS,
+    METRIC_LAST_REFRESH,
+    METRIC_SERIES,
+    METRIC_TREE_PRUNED_REQUESTS,
+    NEGATIVE_CACHE_SKIPPED,
+    RESTORED_SNAPSHOT,
+    CONFIG_RELOADS,
+)
+from metrics.MetricScheduler import IDLE_SECONDS, MetricScheduler
+from metrics.MetricTreeCache import MetricTreeCache
+from metrics.NegativeCache import NegativeCache
+from metrics.QueryPlanner import MetricQuery, QueryPlanner
+from metrics.RemoteWriter import RemoteWriter
+from metrics.ScrapeEngine import ScrapeEngine, ScrapeRequest
+from metrics.ShardSelector import ShardSelector
+from metrics.SnapshotCollector import CardinalityLimits, MetricDefinition, SeriesSnapshot, SnapshotBuilder, SnapshotCollector
+from metrics.SnapshotStore import SnapshotStore
 from util.asyncio_utils import AsyncioUtils
+from util.reload_utils import ReloadTrigger
 from util.stdlib_utils import isBase64, base64Encode, base64Decode
 
+ENCODING_PREFIX = "ENCODED"
+# bumped whenever the layout of compiled mapping files changes, older ones are then compiled again
+MAPPING_CACHE_VERSION = 1
+
 
 @dataclass
 class AppDMetric:
@@ -18,69 +50,238 @@ class AppDMetric:
     metric_path: str
     metric_name: str
     labels: list[str]
+    refresh_interval_minutes: Optional[float] = None
+    max_series: Optional[int] = None
 
-    def to_prom_metric(self):
+    @cached_property
+    def wildcard_indices(self) -> list[int]:
+        """Positions of the metric path segments which become labels, e.g. [1, 3] for my|*|path|*"""
+        return [i for i, x in enumerate(self.metric_path.split("|")) if x == "*"]
+
+    @cached_property
+    def prom_name(self) -> str:
         metric_path = self.metric_path.replace("*", "{}").lower()
         metric_path = self.entity_type.lower() + ":" + metric_path.format(*[label.upper() for label in self.labels])
         return "".join([c if c.isalnum() or c == ":" else "_" for c in metric_path])
 
+    def to_prom_metric(self):
+        return self.prom_name
+
+
+@dataclass
+class CompiledMapping:
+    """A mapping file parsed into its metrics, their metric families and the metric queries planned for them"""
+
+    metrics: list[tuple[AppDMetric, int]]
+    definitions: list[MetricDefinition]
+    queries: list[MetricQuery]
+
+    def to_json(self, digest: str) -> dict:
+        index = {id(metric): i for i, (metric, _) in enumerate(self.metrics)}
+        return {
+            "version": MAPPING_CACHE_VERSION,
+            "sha256": digest,
+            "metrics": [
+                {**dataclasses.asdict(metric), "family": family, "prom_name": metric.prom_name, "wildcard_indices": metric.wildcard_indices}
+                for metric, family in self.metrics
+            ],
+            "definitions": [dataclasses.astuple(definition) for definition in self.definitions],
+            "queries": [
+                {
+                    "entity_type": query.entity_type,
+                    "metric_path": query.metric_path,
+                    "route_indices": query.route_indices,
+                    "refresh_interval_minutes": query.refresh_interval_minutes,
+                    "rows": [index[id(metric)] for metric in query.metrics],
+                }
+                for query in self.queries
+            ],
+        }
+
+    @staticmethod
+    def from_json(compiled: dict) -> "CompiledMapping":
+        metrics = []
+        for row in compiled["metrics"]:
+            family = row.pop("family")
+            # precomputed cached_property values, so names are never rebuilt from the metric path
+            precomputed = {"prom_name": row.pop("prom_name"), "wildcard_indices": row.pop("wildcard_indices")}
+            metric = AppDMetric(**row)
+            vars(metric).update(precomputed)
+            metrics.append((metric, family))
+        definitions = [MetricDefinition(name, documentation, tuple(labelnames)) for name, documentation, labelnames in compiled["definitions"]]
+        queries = []
+        for planned in compiled["queries"]:
+            query = MetricQuery(planned["entity_type"], planned["metric_path"], planned["route_indices"], planned["refresh_interval_minutes"])
+            for row in planned["rows"]:
+                query.add(*metrics[row])
+            queries.append(query)
+        return CompiledMapping(metrics, definitions, queries)
+
 
 class AppDMetrics:
-    def __init__(self, concurrent_connections: int, job_file: str, mapping_file: str):
-        if not Path(f"input/{job_file}.json").exists():
-            logging.error(f"Job file {job_file} does not exist")
-            sys.exit(1)
+    def __init__(
+            self,
+            concurrent_connections: int,
+            job_file: str,
+            mapping_file: str,
+            cycle_deadline_seconds: float = None,
+            shard: ShardSelector = None,
+            cardinality_limits: CardinalityLimits = None,
+            controller_indices: list[int] = None,
+            on_publish: Callable[[SeriesSnapshot], None] = None,
+            record_file: str = None,
+            record_cycles: int = 1,
+            state_file: str = None,
+            state_save_seconds: float = 60,
+            reload_trigger: ReloadTrigger = None,
+            remote_writer: RemoteWriter = None,
+    ):
+        self.job_file = job_file
+        self.mapping_file = mapping_file
+        self.job = self.load_job(job_file)
         if not Path(f"input/{mapping_file}.tsv").exists():
             logging.error(f"Mapping file {mapping_file} does not exist")
             sys.exit(1)
 
-        self.job = json.loads(open(f"input/{job_file}.json").read())
-
         # Default concurrent connections to 10 for On-Premise controllers
         if any(job for job in self.job if "saas.appdynamics.com" not in job["host"]):
             logging.info(f"On-Premise controller detected. It is recommended to use a maximum of 10 concurrent connections.")
-            concurrent_connections = 10 if concurrent_connections is None else concurrent_connections
+            AsyncioUtils.init(10 if concurrent_connections is None else concurrent_connections)
         else:
             logging.info(f"SaaS controller detected. It is recommended to use a maximum of 50 concurrent connections.")
-            concurrent_connections = 50 if concurrent_connections is None else concurrent_connections
-        AsyncioUtils.init(concurrent_connections)
+            AsyncioUtils.init(50 if concurrent_connections is None else concurrent_connections)
 
-        # Convert passwords to base64 if they aren't already
-        encoding_prefix = "ENCODED"
-        for controller in self.job:
-            if not isBase64(controller["pwd"]):
-                controller["pwd"] = base64Encode(f"{encoding_prefix}-{controller['pwd']}")
-            elif not base64Decode(controller["pwd"]).startswith(f"{encoding_prefix}-"):
-                controller["pwd"] = base64Encode(f"{encoding_prefix}-{controller['pwd']}")
-
-        # Save the job back to disk with the updated password
-        self.refreshIntervalMinutes = self.job[0]["refreshIntervalMinutes"]
-        with open(f"input/{job_file}.json", "w", encoding="ISO-8859-1") as f:
-            json.dump(
-                self.job,
-                fp=f,
-                ensure_ascii=False,
-                indent=4,
-            )
+        if controller_indices is not None:
+            self.job = [controller for i, controller in enumerate(self.job) if i in controller_indices]
 
         # Instantiate controllers
-        self.controllers = [
-            AppDService(
-                host=controller["host"],
-                port=controller["port"],
-                ssl=controller["ssl"],
-                account=controller["account"],
-                username=controller["username"],
-                pwd=base64Decode(controller["pwd"])[len(f"{encoding_prefix}-"):],
-                verifySsl=controller.get("verifySsl", True),
-                useProxy=controller.get("useProxy", False),
-                applicationFilter=controller.get("applicationFilter", None),
-                timeRangeMins=controller.get("refreshIntervalMinutes", 1),
-            )
-            for controller in self.job
-        ]
+        self.concurrentConnections = concurrent_connections
+        self.controllers = [self.create_controller(controller) for controller in self.job]
+
+        self.recorder = None
+        if record_file is not None:
+            self.recorder = TrafficRecorder(record_file, mapping_file, self.job, record_cycles)
+            for controller in self.controllers:
+                controller.recorder = self.recorder
+            logging.info(f"Recording {record_cycles} metric cycles of controller traffic to {record_file}")
+
+        self.mapping = self.compile_mapping(mapping_file)
+        self.metrics, definitions = self.mapping.metrics, self.mapping.definitions
+
+        self.collector = SnapshotCollector(definitions)
+        REGISTRY.register(self.collector)
+        self.on_publish = on_publish
+        self.limits = dataclasses.replace(cardinality_limits or CardinalityLimits(), perMetric=tuple(metric.max_series for metric, _ in self.metrics))
+        self.builder: Optional[SnapshotBuilder] = None
+
+        self.queries = self.mapping.queries
+        self.engine = ScrapeEngine(self.handleMetricData, self.routeMetricRecord)
+        self.discovery = DiscoveryCache()
+        self.metricTrees = MetricTreeCache(self.queries)
+        self.scheduler = MetricScheduler()
+        self.negativeCache = NegativeCache()
+        self.cycleDeadlineSeconds = cycle_deadline_seconds
+        self.shard = shard or ShardSelector()
+        if self.shard.shardCount > 1:
+            logging.info(f"Running as shard {self.shard.shardIndex} of {self.shard.shardCount}")
+        self.lastRefresh: dict[tuple[AppDService, MetricQuery, int], float] = {}
+        for controller in self.controllers:
+            for query in self.queries:
+                self.scheduler.schedule(controller, query)
+        self.reloads = reload_trigger
+        # controllers added by a reload, which may fail to log in without aborting
+        self.reloaded: set[AppDService] = set()
+        self.remoteWriter = remote_writer
+
+        self.store = None
+        if state_file is not None:
+            self.store = SnapshotStore(state_file, state_save_seconds)
+            self.restore()
+
+    def create_controller(self, controller: dict) -> AppDService:
+        return AppDService(
+            host=controller["host"],
+            port=controller["port"],
+            ssl=controller["ssl"],
+            account=controller["account"],
+            username=controller["username"],
+            pwd=base64Decode(controller["pwd"])[len(f"{ENCODING_PREFIX}-"):],
+            verifySsl=controller.get("verifySsl", True),
+            useProxy=controller.get("useProxy", False),
+            applicationFilter=controller.get("applicationFilter", None),
+            timeRangeMins=controller.get("refreshIntervalMinutes", 1),
+            refreshIntervalMinutes=controller.get("refreshIntervalMinutes", 1),
+            concurrentConnections=self.getConcurrentConnections(controller, self.concurrentConnections),
+            maxConcurrentConnections=controller.get("maxConcurrentConnections"),
+            discoveryRefreshMinutes=controller.get("discoveryRefreshMinutes", 60),
+            requestTimeoutSeconds=controller.get("requestTimeoutSeconds", 60),
+            maxRetries=controller.get("maxRetries", 3),
+            negativeCacheMaxMinutes=controller.get("negativeCacheMaxMinutes", 60),
+            metricTreeRefreshMinutes=controller.get("metricTreeRefreshMinutes", 0),
+        )
+
+    @staticmethod
+    def load_job(job_file: str) -> list[dict]:
+        """Reads the job file, encoding any plain text passwords in it"""
+        if not Path(f"input/{job_file}.json").exists():
+            logging.error(f"Job file {job_file} does not exist")
+            sys.exit(1)
+
+        job = json.loads(open(f"input/{job_file}.json").read())
+
+        # Convert passwords to base64 if they aren't already
+        encoded = False
+        for controller in job:
+            if not isBase64(controller["pwd"]) or not base64Decode(controller["pwd"]).startswith(f"{ENCODING_PREFIX}-"):
+                controller["pwd"] = base64Encode(f"{ENCODING_PREFIX}-{controller['pwd']}")
+                encoded = True
+
+        # Save the job back to disk with the updated password, only when one was encoded so worker processes never race
+        if encoded:
+            with open(f"input/{job_file}.json", "w", encoding="ISO-8859-1") as f:
+                json.dump(
+                    job,
+                    fp=f,
+                    ensure_ascii=False,
+                    indent=4,
+                )
+        return job
 
-        self.metrics = []
+    @staticmethod
+    def compile_mapping(mapping_file: str) -> CompiledMapping:
+        """
+        Parses and plans the mapping file, reusing the compiled mapping cached in input/.cache as long as the
+        mapping file's content hash is unchanged
+        """
+        content = open(f"input/{mapping_file}.tsv", "rb").read()
+        digest = hashlib.sha256(content).hexdigest()
+        cache_file = f"input/.cache/{mapping_file}.json"
+        try:
+            compiled = json.loads(open(cache_file).read())
+            if compiled["version"] == MAPPING_CACHE_VERSION and compiled["sha256"] == digest:
+                mapping = CompiledMapping.from_json(compiled)
+                logging.info(f"Loaded {len(mapping.metrics)} metrics and {len(mapping.queries)} metric queries compiled from mapping file {mapping_file}")
+                return mapping
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"Compiling mapping file {mapping_file}, no usable compiled mapping: {e!r}")
+
+        metrics, definitions = AppDMetrics.load_mapping(mapping_file)
+        mapping = CompiledMapping(metrics, definitions, QueryPlanner.plan(metrics))
+        try:
+            os.makedirs("input/.cache", exist_ok=True)
+            # written under a temporary name first, worker processes or exporters sharing input/ may compile concurrently
+            temporary = f"{cache_file}.{os.getpid()}"
+            with open(temporary, "w") as f:
+                json.dump(mapping.to_json(digest), f)
+            os.replace(temporary, cache_file)
+        except OSError as e:
+            logging.warning(f"Unable to cache compiled mapping file {mapping_file}: {e}")
+        return mapping
+
+    @staticmethod
+    def load_mapping(mapping_file: str) -> tuple[list[tuple[AppDMetric, int]], list[MetricDefinition]]:
+        """Parses the mapping file into (metric, family index) pairs and the definitions of their metric families"""
+        metrics = []
         metrics_tsv = open(f"input/{mapping_file}.tsv").read()
         appd_metrics = []
         for line in metrics_tsv.split("\n")[1:]:
@@ -88,118 +289,375 @@ class AppDMetrics:
                 line = line.replace('"', "").split("\t")
                 labels = line[3].split(",")
                 line[3] = labels if labels != [""] else []
+                if len(line) > 4:
+                    line[4] = float(line[4]) if line[4].strip() else None
+                if len(line) > 5:
+                    line[5] = int(line[5]) if line[5].strip() else None
                 appd_metrics.append(AppDMetric(*line))
 
+        definitions = []
         for metric in appd_metrics:
-            logging.info(f"Registering metric: {metric.to_prom_metric()}")
-            gauge = Gauge(
-                name=metric.to_prom_metric(),
-                documentation=metric.metric_name,
-                labelnames=["controller", "application", *metric.labels],
-            )
-            self.metrics.append((metric, gauge))
+            name = metric.to_prom_metric()
+            if any(definition.name == name for definition in definitions):
+                logging.error(f"Metric {name} is defined more than once in mapping file {mapping_file}. Skipping duplicate.")
+                continue
+            if metric.metric_path.split("|").count("*") != len(metric.labels):
+                logging.error(f"Metric {name} has a different number of wildcards and labels. Skipping.")
+                continue
+            logging.info(f"Registering metric: {name}")
+            definitions.append(MetricDefinition(name, metric.metric_name, ("controller", "application", *metric.labels)))
+            metrics.append((metric, len(definitions) - 1))
+        return metrics, definitions
+
+    @staticmethod
+    def getConcurrentConnections(controller: dict, concurrent_connections: int) -> int:
+        """Each controller gets its own concurrency budget: job file, then -c, then 10 On-Premise / 50 SaaS"""
+        if controller.get("concurrentConnections") is not None:
+            budget = controller["concurrentConnections"]
+        elif concurrent_connections is not None:
+            budget = concurrent_connections
+        else:
+            budget = 50 if "saas.appdynamics.com" in controller["host"] else 10
+        return AsyncioUtils.clampConcurrentConnections(budget, controller["host"])
 
     async def run_metrics_loop(self):
+        if self.reloads is not None:
+            self.reloads.start()
+        if self.remoteWriter is not None:
+            self.remoteWriter.start()
         while True:
-            start = time.time()
-            await self.fetch()
-            end = time.time()
-            logging.info(f"Metrics loop completed in {end - start} seconds")
-            seconds_to_sleep = self.refreshIntervalMinutes * 60 - (end - start)
-
-            if seconds_to_sleep < 0:
-                logging.warning(f"Metrics loop took longer than the refresh interval. Skipping sleep.")
-                logging.warning(
-                    f"Consider increasing refreshIntervalMinutes from {self.refreshIntervalMinutes} to at least {(int(end - start) // 60) + 1}")
-                continue
+            if self.reloads is not None and self.reloads.event.is_set():
+                await self.reload()
+                self.reloads.consume()
+
+            due = self.scheduler.popDue()
+            if due:
+                start = time.time()
+                await self.fetch([(item.controller, item.query) for item in due])
+                end = time.time()
+                logging.info(f"Metrics loop completed in {end - start} seconds")
+                if self.recorder is not None:
+                    scheduled = [(controller, query) for controller in self.controllers for query in self.queries]
+                    if self.recorder.completeBatch([(item.controller, item.query) for item in due], scheduled):
+                        for controller in self.controllers:
+                            controller.recorder = None
+                        self.recorder = None
+                self.scheduler.reschedule(due, end)
 
-            logging.info(f"Sleeping for {seconds_to_sleep} seconds")
-            await AsyncioUtils.sleep(seconds_to_sleep)
-
-    async def fetch(self):
-        loginFutures = [controller.loginToController() for controller in self.controllers]
-        loginResults = await AsyncioUtils.gatherWithConcurrency(*loginFutures)
-        if any(login.error is not None for login in loginResults):
-            await self.abortAndCleanup(f"Unable to connect to one or more controllers. Aborting.")
-
-        apmApplicationsFutures = [controller.getApmApplications() for controller in self.controllers]
-        apmApplicationsResults = await AsyncioUtils.gatherWithConcurrency(*apmApplicationsFutures)
-        if any(apmApplications.error is not None for apmApplications in apmApplicationsResults):
-            await self.abortAndCleanup(f"Unable to retrieve APM applications from one or more controllers. Aborting.")
-
-        brumApplicationsFutures = [controller.getEumApplications() for controller in self.controllers]
-        brumApplicationsResults = await AsyncioUtils.gatherWithConcurrency(*brumApplicationsFutures)
-        if any(brumApplications.error is not None for brumApplications in brumApplicationsResults):
-            await self.abortAndCleanup(f"Unable to retrieve BRUM applications from one or more controllers. Aborting.")
-
-        mrumApplicationsFutures = [controller.getMRUMApplications() for controller in self.controllers]
-        mrumApplicationsResults = await AsyncioUtils.gatherWithConcurrency(*mrumApplicationsFutures)
-        if any(mrumApplications.error is not None for mrumApplications in mrumApplicationsResults):
-            await self.abortAndCleanup(f"Unable to retrieve MRUM applications from one or more controllers. Aborting.")
-
-        extendedApplicationsFutures = [controller.getApplicationsAllTypes() for controller in self.controllers]
-        extendedApplicationsResults = await AsyncioUtils.gatherWithConcurrency(*extendedApplicationsFutures)
-        if any(extendedApplications.error is not None for extendedApplications in extendedApplicationsResults):
-            await self.abortAndCleanup(f"Unable to retrieve extended applications from one or more controllers. Aborting.")
-
-        for idx, controller in enumerate(self.controllers):
-            apmApplications = apmApplicationsResults[idx].data
-            brumApplications = brumApplicationsResults[idx].data
-            mrumApplications = mrumApplicationsResults[idx].data
-            extendedApplications = extendedApplicationsResults[idx].data
-
-            metrics_to_fetch = self.metrics
-            i = 0
-            for metric, gauge in metrics_to_fetch:
-                logging.info(f"Fetching metric: {metric.to_prom_metric()} ({i + 1}/{len(metrics_to_fetch)})")
-                i += 1
-
-                if metric.entity_type == "APM":
-                    root = apmApplications
-                elif metric.entity_type == "ANALYTICS":
-                    root = [extendedApplications["analyticsApplication"]]
-                elif metric.entity_type == "DATABASE":
-                    root = [extendedApplications["dbMonApplication"]]
-                elif metric.entity_type == "BRUM":
-                    root = brumApplications
-                elif metric.entity_type == "MRUM":
-                    for app in mrumApplications:
-                        app["id"] = app["applicationId"]
-                    root = mrumApplications
-                elif metric.entity_type == "SIM":
-                    root = [extendedApplications["simApplication"]]
+            seconds_to_sleep = self.scheduler.secondsUntilNextDue()
+            if seconds_to_sleep is None:
+                logging.warning(f"No metric queries are scheduled, check the job and mapping files. Checking again in {IDLE_SECONDS} seconds")
+                seconds_to_sleep = IDLE_SECONDS
+            if seconds_to_sleep > 0:
+                logging.info(f"Sleeping for {seconds_to_sleep} seconds")
+                if self.reloads is not None:
+                    await self.reloads.wait(seconds_to_sleep)
                 else:
-                    logging.error(f"Unknown entity type: {metric.entity_type}")
+                    await AsyncioUtils.sleep(seconds_to_sleep)
+
+    async def fetch(self, due: list[tuple[AppDService, MetricQuery]] = None):
+        """Fetches the given (controller, query) pairs, or every query from every controller"""
+        start = time.time()
+        if due is None:
+            due = [(controller, query) for controller in self.controllers for query in self.queries]
+        controllers = list(dict.fromkeys(controller for controller, _ in due))
+        for controller in controllers:
+            controller.retryBudget.reset()
+
+        with CYCLE_PHASE_DURATION.labels("login").time():
+            loginFutures = [controller.ensureLoggedIn() for controller in controllers]
+            loginResults = await AsyncioUtils.gatherWithConcurrency(*loginFutures)
+            failed = [controller for controller, login in zip(controllers, loginResults) if login.error is not None]
+            if any(controller not in self.reloaded for controller in failed):
+                await self.abortAndCleanup(f"Unable to connect to one or more controllers. Aborting.")
+            # a bad entry added by a reload must not take down the controllers which were already running
+            for controller in failed:
+                logging.error(f"{controller.host} - Unable to connect to controller added by reload. Skipping controller this cycle.")
+
+        with CYCLE_PHASE_DURATION.labels("discovery").time():
+            loggedIn = [controller for controller in controllers if controller not in failed]
+            inventories = await AsyncioUtils.gatherWithConcurrency(*[self.discovery.get(controller) for controller in loggedIn])
+            inventories = {**dict(zip(loggedIn, inventories)), **{controller: None for controller in failed}}
+            for controller in loggedIn:
+                if inventories[controller] is None:
+                    logging.warning(f"{controller.host} - No application inventory available yet. Skipping controller this cycle.")
+
+        with CYCLE_PHASE_DURATION.labels("metrics").time():
+            self.builder = SnapshotBuilder(self.collector.definitions, self.collector.snapshot, self.limits)
+            requests = []
+            entities = {}
+            negativeSkipped = 0
+            pruned = 0
+            for controller, query in due:
+                inventory = inventories[controller]
+                if inventory is None:
                     continue
+                selected = self.shard.select(controller.host, inventory.entities(query.entity_type))
+                applications = {entity["name"] for entity in selected}
+                for family in query.targets:
+                    self.builder.retain(family, controller.host, applications)
+                entities[(controller, query)] = []
+                for entity in selected:
+                    path = self.metricTrees.path(controller, entity, query)
+                    if path is None:
+                        # the application's metric tree has nothing for this query
+                        for family in query.targets:
+                            self.builder.clear(family, controller.host, entity["name"])
+                        METRIC_TREE_PRUNED_REQUESTS.labels(controller.host).inc()
+                        pruned += 1
+                    elif self.negativeCache.skip((controller.host, entity["id"], query.metric_path)):
+                        # requests which keep coming back empty are only re-probed once their backoff has passed
+                        NEGATIVE_CACHE_SKIPPED.labels(controller.host).inc()
+                        negativeSkipped += 1
+                    else:
+                        entities[(controller, query)].append(entity)
+                        requests.append(ScrapeRequest(controller, entity, path, query))
+            if pruned:
+                logging.info(f"Pruned {pruned} metric requests for metrics missing from their application's metric tree")
+            if negativeSkipped:
+                logging.info(f"Skipped {negativeSkipped} metric requests which keep returning no values, see appd_exporter_negative_cache_skipped_requests_total")
+
+            # stalest first, so requests cut off by the previous cycle's deadline are carried over to the front of this one
+            requests.sort(key=lambda request: self.lastRefresh.get((request.controller, request.target, request.entity["id"]), 0))
+            for request in requests:
+                self.engine.submit(request)
+
+            logging.info(f"Fetching {len(due)} metric queries from {len(controllers)} controllers")
+            deadline = None
+            if self.cycleDeadlineSeconds is not None:
+                deadline = max(self.cycleDeadlineSeconds - (time.time() - start), 0)
+            skipped = await self.engine.run(deadline)
+            if skipped:
+                logging.warning(
+                    f"Cycle deadline of {self.cycleDeadlineSeconds} seconds reached. "
+                    f"Cancelled {len(skipped)} metric requests, their series are carried over from the previous cycle."
+                )
+                for request in skipped:
+                    DEADLINE_SKIPPED_REQUESTS.labels(request.controller.host).inc()
+
+        with CYCLE_PHASE_DURATION.labels("publish").time():
+            snapshot = self.builder.build()
+            self.collector.publish(snapshot)
+            logging.info(f"Published {snapshot.seriesCount} series")
+            if self.builder.dropped:
+                logging.warning(f"Dropped {self.builder.dropped} series over the cardinality limits, see appd_exporter_series_dropped_total")
+            # the snapshot holds every series compactly, don't keep their label tuples around until the next cycle
+            self.builder = None
+
+            for definition, family in zip(self.collector.definitions, snapshot.families):
+                METRIC_SERIES.labels(definition.name).set(len(family))
+            for (controller, query), queried in entities.items():
+                if queried:
+                    oldest = min(self.lastRefresh.get((controller, query, entity["id"]), 0) for entity in queried)
+                    for metric in query.metrics:
+                        METRIC_LAST_REFRESH.labels(controller.host, metric.to_prom_metric()).set(oldest)
+        if self.on_publish is not None:
+            self.on_publish(snapshot)
+        if self.remoteWriter is not None:
+            self.remoteWriter.enqueue(snapshot, self.collector.definitions)
+        if self.store is not None:
+            self.store.save(snapshot, self.collector.definitions, self.state())
+
+    def state(self) -> dict:
+        """What a restarted exporter needs to resume scraping, see restore"""
+        entityRefresh = {}
+        for (controller, query, entityId), refreshedAt in self.lastRefresh.items():
+            entityRefresh.setdefault((controller.host, *query.signature), []).append([entityId, refreshedAt])
+        return {
+            "inventories": {controller.host: dataclasses.asdict(inventory) for controller, inventory in self.discovery.inventories.items()},
+            "sessions": {controller.host: controller.sessionCookies() for controller in self.controllers if controller.sessionCookies() is not None},
+            "lastRefresh": [[sample.labels["controller"], sample.labels["metric"], sample.value] for sample in METRIC_LAST_REFRESH.collect()[0].samples],
+            "entityRefresh": [[*key, refreshes] for key, refreshes in entityRefresh.items()],
+        }
+
+    def restore(self):
+        """
+        Serves the series saved by a previous run until they are refreshed, marked stale by their last refresh time,
+        and resumes its application inventories and controller sessions
+        """
+        restored = self.store.load(self.collector.definitions)
+        if restored is None:
+            return
+        snapshot, state = restored
+        controllers = {controller.host: controller for controller in self.controllers}
+
+        # series of controllers which are no longer scraped by this process would never be refreshed
+        builder = SnapshotBuilder(self.collector.definitions, snapshot)
+        removed = {host for series in builder.series for host, _ in series} - set(controllers)
+        if removed:
+            for family in range(len(self.collector.definitions)):
+                for host in removed:
+                    builder.retain(family, host, set())
+            snapshot = dataclasses.replace(builder.build(), createdAt=snapshot.createdAt)
+
+        self.collector.publish(snapshot)
+        RESTORED_SNAPSHOT.set(snapshot.createdAt)
+        for definition, family in zip(self.collector.definitions, snapshot.families):
+            METRIC_SERIES.labels(definition.name).set(len(family))
+        for host, metric, refreshedAt in state.get("lastRefresh", []):
+            if host in controllers:
+                METRIC_LAST_REFRESH.labels(host, metric).set(refreshedAt)
+        # the gauge is published from the refresh time of every queried entity, which would be 0 for entities not refreshed yet
+        queries = {query.signature: query for query in self.queries}
+        for host, entity_type, metric_path, refresh_interval_minutes, refreshes in state.get("entityRefresh", []):
+            query = queries.get((entity_type, metric_path, refresh_interval_minutes))
+            if host in controllers and query is not None:
+                for entityId, refreshedAt in refreshes:
+                    self.lastRefresh[(controllers[host], query, entityId)] = refreshedAt
+        for host, inventory in state.get("inventories", {}).items():
+            if host in controllers:
+                self.discovery.restore(controllers[host], ApplicationInventory(**inventory))
+        for host, cookies in state.get("sessions", {}).items():
+            if host in controllers:
+                controllers[host].restoreSession(cookies)
+        logging.info(f"Restored {snapshot.seriesCount} series from {time.ctime(snapshot.createdAt)}, serving them until they are refreshed")
+
+    @staticmethod
+    def routeMetricRecord(request: ScrapeRequest, segments: list[str], value: float):
+        """Routes each streamed metric back to the mapping rows it belongs to, labelled by the row's wildcards"""
+        # e.g. my|metric|path|*|* will return something like my|metric|path|label1|label2
+        for _, family, labels in request.target.route(segments):
+            request.staged[(family, tuple(labels))] = value
+
+    def handleMetricData(self, request: ScrapeRequest, metric_data: Result):
+        query: MetricQuery = request.target
+        controller, entity = request.controller, request.entity
+        backoff = self.negativeCache.record(
+            (controller.host, entity["id"], query.metric_path),
+            metric_data,
+            MetricScheduler.intervalSeconds(controller, query),
+            controller.negativeCacheMaxMinutes,
+        )
+        if backoff is not None:
+            logging.debug(
+                f"{controller.host} - Metric query: {query.metric_path} for entity: {entity['name']} returned no values {backoff.misses} times in a row, "
+                f"next attempt at {time.ctime(backoff.retryAt)}"
+            )
+        if metric_data.error and backoff is not None:
+            # the controller keeps rejecting the query, don't serve its last values until it is re-probed
+            for family in query.targets:
+                self.builder.clear(family, controller.host, entity["name"])
+            return
+        if metric_data.error:
+            # keep the series from the previous cycle, they are marked stale by appd_exporter_metric_last_refresh_timestamp_seconds
+            logging.error(f"Error fetching metric query: {query.metric_path} for entity: {entity['name']}")
+            return
+
+        self.lastRefresh[(controller, query, entity["id"])] = time.time()
+        for family in query.targets:
+            self.builder.clear(family, controller.host, entity["name"])
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for (family, labels), value in request.staged.items():
+            if debug:
+                logging.debug(f"Setting metric: {self.collector.definitions[family].name} with labels: {list(labels)} to value: {value}")
+            self.builder.add(family, (controller.host, entity["name"], *labels), value)
+
+    async def reload(self):
+        """
+        Applies changes to the job and mapping files between metrics cycles. Controllers whose job entry is unchanged
+        keep their session, caches and schedule, an edited entry is replaced by a new controller. Metric families and
+        queries which are unchanged keep their series and schedule, removed ones are dropped and new ones fetched right away.
+        """
+        if not Path(f"input/{self.job_file}.json").exists() or not Path(f"input/{self.mapping_file}.tsv").exists():
+            logging.error(f"Job file {self.job_file} or mapping file {self.mapping_file} does not exist. Keeping the current configuration.")
+            CONFIG_RELOADS.labels("failure").inc()
+            return
+        try:
+            job = self.load_job(self.job_file)
+            mapping = self.compile_mapping(self.mapping_file)
+        except Exception as e:
+            logging.error(f"Unable to reload job file {self.job_file} and mapping file {self.mapping_file}: {e}. Keeping the current configuration.")
+            CONFIG_RELOADS.labels("failure").inc()
+            return
+        if not job or not mapping.queries:
+            # nothing would be scheduled, keep scraping what is configured now
+            empty = f"Job file {self.job_file} has no controllers" if not job else f"Mapping file {self.mapping_file} has no metric queries"
+            logging.error(f"{empty}. Keeping the current configuration.")
+            CONFIG_RELOADS.labels("failure").inc()
+            return
+
+        # controllers are matched by their whole job entry
+        current = {}
+        for entry, controller in zip(self.job, self.controllers):
+            current.setdefault(json.dumps(entry, sort_keys=True), []).append(controller)
+        controllers = []
+        for entry in job:
+            unchanged = current.get(json.dumps(entry, sort_keys=True))
+            controllers.append(unchanged.pop(0) if unchanged else self.create_controller(entry))
+            controllers[-1].recorder = self.recorder
+        removed = [controller for unchanged in current.values() for controller in unchanged]
+        added = [controller for controller in controllers if controller not in self.controllers]
+        hosts = {controller.host for controller in controllers}
+        removedHosts = {controller.host for controller in removed} - hosts
+        for controller in removed:
+            self.discovery.forget(controller)
+            self.metricTrees.forget(controller)
+            await controller.close()
+        for host in removedHosts:
+            self.negativeCache.forget(host)
+
+        definitions = self.collector.definitions
+        snapshot = self.collector.snapshot
+        mappingChanged = mapping.to_json("") != self.mapping.to_json("")
+        if mappingChanged:
+            # families are matched by name and labels, their series are kept
+            families = {(definition.name, definition.labelnames): columns for definition, columns in zip(definitions, snapshot.families)}
+            empty = SeriesSnapshot.empty(mapping.definitions).families
+            snapshot = SeriesSnapshot(
+                tuple(families.get((definition.name, definition.labelnames), columns) for definition, columns in zip(mapping.definitions, empty)),
+                snapshot.createdAt,
+                snapshot.labelValues,
+            )
+            definitions = mapping.definitions
+            self.mapping, self.metrics, self.queries = mapping, mapping.metrics, mapping.queries
+            self.limits = dataclasses.replace(self.limits, perMetric=tuple(metric.max_series for metric, _ in self.metrics))
+            self.metricTrees = MetricTreeCache(self.queries)
+        if removedHosts:
+            builder = SnapshotBuilder(definitions, snapshot)
+            for family in range(len(definitions)):
+                for host in removedHosts:
+                    builder.retain(family, host, set())
+            snapshot = dataclasses.replace(builder.build(), createdAt=snapshot.createdAt)
+        if mappingChanged or removedHosts:
+            self.collector.publish(snapshot, definitions)
+            names = {definition.name for definition in definitions}
+            for sample in METRIC_SERIES.collect()[0].samples:
+                if sample.labels["metric"] not in names:
+                    METRIC_SERIES.remove(sample.labels["metric"])
+            for sample in METRIC_LAST_REFRESH.collect()[0].samples:
+                if sample.labels["controller"] in removedHosts or sample.labels["metric"] not in names:
+                    METRIC_LAST_REFRESH.remove(sample.labels["controller"], sample.labels["metric"])
+
+        # unchanged (controller, query) pairs stay due when they were, new ones and ones routing other rows are due right away
+        queries = {query.signature: query for query in self.queries}
+        scheduled = {(item.controller, item.query.signature): item for item in self.scheduler.heap}
+        self.scheduler = MetricScheduler()
+        for controller in controllers:
+            for query in self.queries:
+                item = scheduled.get((controller, query.signature))
+                unchanged = item is not None and item.query.metrics == query.metrics
+                self.scheduler.schedule(controller, query, item.dueAt if unchanged else None)
+        self.lastRefresh = {
+            (controller, queries[query.signature], entity): refreshedAt
+            for (controller, query, entity), refreshedAt in self.lastRefresh.items()
+            if controller in controllers and query.signature in queries
+        }
+        self.job, self.controllers = job, controllers
+        self.reloaded = {controller for controller in self.reloaded if controller in controllers} | set(added)
 
-                metric_data_futures = [controller.getMetricData(
-                    entity["id"],
-                    metric.metric_path,
-                    rollup=True,
-                    time_range_type="BEFORE_NOW",
-                    duration_in_mins=controller.timeRangeMins,
-                ) for entity in root]
-                metric_data_results = await AsyncioUtils.gatherWithConcurrency(*metric_data_futures)
-
-                for entity, metric_data in zip(root, metric_data_results):
-                    if metric_data.error:
-                        logging.error(f"Error fetching metric: {metric.to_prom_metric()} for entity: {entity['name']}")
-                    if metric_data.error is None and metric_data.data:
-                        # for each wildcard index, parse the returned metric path and add the label
-                        # e.g. my|metric|path|*|* will return something like my|metric|path|label1|label2
-                        wildcard_indices = [i for i, x in enumerate(metric.metric_path.split("|")) if x == "*"]
-                        for labeled_metric in metric_data.data:
-                            if labeled_metric["metricValues"]:
-                                value = labeled_metric["metricValues"][0]["value"]
-                                labels = []
-                                for index in wildcard_indices:
-                                    labels.append(labeled_metric["metricPath"].split("|")[index])
-                                logging.debug(f"Setting metric: {metric.to_prom_metric()} with labels: {labels} to value: {value}")
-                                gauge.labels(controller.host, entity["name"], *labels).set(value)
+        CONFIG_RELOADS.labels("success").inc()
+        logging.info(
+            f"Reloaded job file {self.job_file} and mapping file {self.mapping_file}: added {len(added)} and removed {len(removed)} controllers, "
+            + (f"{len(definitions)} metrics and {len(self.queries)} metric queries" if mappingChanged else "mapping unchanged")
+        )
 
     async def abortAndCleanup(self, msg: str, error=True):
         """Closes open controller connections"""
         await AsyncioUtils.gatherWithConcurrency(*[controller.close() for controller in self.controllers])
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.remoteWriter is not None:
+            await self.remoteWriter.close()
         if error:
             logging.error(msg)
             sys.exit(1)
@@ -9,6 +9,7 @@ class Result(Generic[T]):
     @dataclass
     class Error:
         msg: str
+        code: Optional[int] = None
 
     data: T
     error: Optional[Error] = None
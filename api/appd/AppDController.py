@@ -45,6 +45,11 @@ class AppdController(Consumer):
     ):
         """Retrieves Metrics"""
 
+    @params({"output": "json"})
+    @get("/controller/rest/applications/{applicationID}/metrics")
+    def getMetricTree(self, applicationID: Path, metric_path: Query("metric-path") = None):
+        """Retrieves the metric browser folders and metrics under a metric path"""
+
     @params({"output": "json"})
     @get("/controller/restui/eumApplications/getAllEumApplicationsData")
     def getEumApplications(self, timeRange: Query("time-range")):
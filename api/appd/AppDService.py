@@ -1,16 +1,39 @@
+import asyncio
 import ipaddress
 import json
 import logging
 import re
 import time
 from json import JSONDecodeError
+from typing import Awaitable, Callable, Optional
 
 import aiohttp
 from api.appd.AppDController import AppdController
+from api.appd.TrafficArchive import TrafficRecorder
 from api.Result import Result
+from metrics.InternalMetrics import (
+    CONCURRENCY_LIMIT,
+    CONTROLLER_REQUESTS,
+    REQUEST_DURATION,
+    REQUEST_FAILURES,
+    REQUEST_RETRIES,
+    REQUEST_TIMEOUTS,
+    REQUESTS_IN_FLIGHT,
+    RESPONSE_BYTES,
+    RESPONSE_DECODE_DURATION,
+    RETRY_BUDGET_EXHAUSTED,
+)
 from uplink import AiohttpClient
 from uplink.auth import BasicAuth, MultiAuth, ProxyAuth
-from util.asyncio_utils import AsyncioUtils
+from util.asyncio_utils import AdaptiveLimiter, AsyncioUtils
+from util.json_utils import JsonArrayReader, JsonUtils
+from util.retry_utils import RETRYABLE_CODES, RetryBudget, backoffDelay, isTimeout, isTransientError, unwrapError
+from yarl import URL
+
+# Status codes returned by the controller once JSESSIONID has expired or been invalidated
+AUTH_EXPIRED_CODES = (401, 403)
+# Status codes with which an overloaded controller asks us to back off
+OVERLOAD_CODES = (429, 503)
 
 
 class AppDService:
@@ -28,16 +51,36 @@ class AppDService:
             useProxy: bool = False,
             applicationFilter: dict = None,
             timeRangeMins: int = 1440,
+            concurrentConnections: int = None,
+            discoveryRefreshMinutes: int = 60,
+            refreshIntervalMinutes: int = 1,
+            maxConcurrentConnections: int = None,
+            requestTimeoutSeconds: float = 60,
+            maxRetries: int = 3,
+            negativeCacheMaxMinutes: float = 60,
+            metricTreeRefreshMinutes: float = 0,
     ):
         logging.debug(f"{host} - Initializing controller service")
         connection_url = f'{"https" if ssl else "http"}://{host}:{port}'
         auth = BasicAuth(f"{username}@{account}", pwd)
         self.host = host
+        self.connectionUrl = connection_url
         self.username = username
         self.applicationFilter = applicationFilter
         self.timeRangeMins = timeRangeMins
-        self.endTime = int(round(time.time() * 1000))
-        self.startTime = self.endTime - (1 * 60 * self.timeRangeMins * 1000)
+        self.concurrentConnections = concurrentConnections or AsyncioUtils.concurrent_connections
+        self.discoveryRefreshMinutes = discoveryRefreshMinutes
+        self.refreshIntervalMinutes = refreshIntervalMinutes
+        self.requestTimeoutSeconds = requestTimeoutSeconds
+        self.maxRetries = maxRetries
+        self.negativeCacheMaxMinutes = negativeCacheMaxMinutes
+        self.metricTreeRefreshMinutes = metricTreeRefreshMinutes
+        self.retryBudget = RetryBudget()
+        self.limiter = AdaptiveLimiter(
+            self.concurrentConnections,
+            maxLimit=min(maxConcurrentConnections or self.concurrentConnections * 2, 100),
+            onLimitChange=CONCURRENCY_LIMIT.labels(host).set,
+        )
 
         cookie_jar = aiohttp.CookieJar()
         try:
@@ -49,7 +92,7 @@ class AppDService:
         except ValueError:
             pass
 
-        connector = aiohttp.TCPConnector(limit=AsyncioUtils.concurrent_connections, verify_ssl=verifySsl)
+        connector = aiohttp.TCPConnector(limit=self.limiter.maxLimit, verify_ssl=verifySsl)
         self.session = aiohttp.ClientSession(connector=connector, trust_env=useProxy, cookie_jar=cookie_jar)
 
         self.controller = AppdController(
@@ -58,6 +101,11 @@ class AppDService:
             client=AiohttpClient(session=self.session),
         )
         self.totalCallsProcessed = 0
+        # set while controller traffic is being recorded to a traffic archive
+        self.recorder: TrafficRecorder = None
+        # incremented on every successful login, lets concurrent requests tell whether someone already re-authenticated
+        self.sessionGeneration = 0
+        self.loginLock = asyncio.Lock()
 
     def __json__(self):
         return {
@@ -68,8 +116,17 @@ class AppDService:
     async def loginToController(self) -> Result:
         logging.debug(f"{self.host} - Attempt controller connection.")
         try:
-            response = await self.controller.login()
+            start = time.monotonic()
+            # logins hold loginLock, a hung one would hold up every request to the controller
+            response = await asyncio.wait_for(self.controller.login(), self.requestTimeoutSeconds)
+            if self.recorder is not None:
+                response = await self.recorder.capture(self.host, response, start)
+            REQUEST_DURATION.labels(self.host, "login").observe(time.monotonic() - start)
+            CONTROLLER_REQUESTS.labels(self.host, "login").inc()
         except Exception as e:
+            if isTimeout(e):
+                REQUEST_TIMEOUTS.labels(self.host).inc()
+                e = f"timeout after {self.requestTimeoutSeconds} seconds"
             logging.error(f"{self.host} - Controller login failed with {e}")
             return Result(
                 None,
@@ -81,15 +138,15 @@ class AppDService:
                 response,
                 Result.Error(f"{self.host} - Controller login failed with {response.status_code}. Check username and password."),
             )
-        try:
-            jsessionid = re.search("JSESSIONID=(\\w|\\d)*", str(response.headers)).group(0).split("JSESSIONID=")[1]
-            self.controller.jsessionid = jsessionid
-        except AttributeError:
+        cookies = {cookie.key: cookie.value for cookie in self.session.cookie_jar}
+        cookies.update({key: morsel.value for key, morsel in response.cookies.items()})
+        if "JSESSIONID" in cookies:
+            self.controller.jsessionid = cookies["JSESSIONID"]
+        else:
             logging.debug(f"{self.host} - Unable to find JSESSIONID in login response. Please verify credentials.")
-        try:
-            xcsrftoken = re.search("X-CSRF-TOKEN=(\\w|\\d)*", str(response.headers)).group(0).split("X-CSRF-TOKEN=")[1]
-            self.controller.xcsrftoken = xcsrftoken
-        except AttributeError:
+        if "X-CSRF-TOKEN" in cookies:
+            self.controller.xcsrftoken = cookies["X-CSRF-TOKEN"]
+        else:
             logging.debug(f"{self.host} - Unable to find X-CSRF-TOKEN in login response. Please verify credentials.")
 
         if self.controller.jsessionid is None or self.controller.xcsrftoken is None:
@@ -98,12 +155,125 @@ class AppDService:
                 Result.Error(f"{self.host} - Valid authentication headers not cached from previous login call. Please verify credentials."),
             )
 
+        self.useSession()
+        logging.debug(f"{self.host} - Controller initialization successful.")
+        return Result(self.controller, None)
+
+    def useSession(self):
         self.controller.session.headers["X-CSRF-TOKEN"] = self.controller.xcsrftoken
         self.controller.session.headers["Set-Cookie"] = f"JSESSIONID={self.controller.jsessionid};X-CSRF-TOKEN={self.controller.xcsrftoken};"
         self.controller.session.headers["Content-Type"] = "application/json;charset=UTF-8"
-
-        logging.debug(f"{self.host} - Controller initialization successful.")
-        return Result(self.controller, None)
+        self.sessionGeneration += 1
+
+    def sessionCookies(self) -> Optional[dict]:
+        """Cookies of the current session, None before the first login"""
+        if self.sessionGeneration == 0:
+            return None
+        return {"JSESSIONID": self.controller.jsessionid, "X-CSRF-TOKEN": self.controller.xcsrftoken}
+
+    def restoreSession(self, cookies: dict):
+        """Resumes a session of a previous run instead of logging in, request() logs in again if it has expired since"""
+        self.session.cookie_jar.update_cookies(cookies, URL(self.connectionUrl))
+        self.controller.jsessionid = cookies["JSESSIONID"]
+        self.controller.xcsrftoken = cookies["X-CSRF-TOKEN"]
+        self.useSession()
+        logging.debug(f"{self.host} - Restored controller session.")
+
+    async def ensureLoggedIn(self) -> Result:
+        """Logs in on first use only, the session is kept across cycles and renewed by request() once it expires"""
+        if self.sessionGeneration > 0:
+            return Result(self.controller, None)
+        return await self.reauthenticate(0)
+
+    async def reauthenticate(self, generation: int) -> Result:
+        """Single-flight re-login, callers which saw the same expired session generation share one login"""
+        async with self.loginLock:
+            if self.sessionGeneration != generation:
+                return Result(self.controller, None)
+            self.session.cookie_jar.clear()
+            self.controller.jsessionid = None
+            self.controller.xcsrftoken = None
+            return await self.loginToController()
+
+    async def request(self, call: Callable[[], Awaitable], debugString: str, endpoint: str, onAttempt: Callable[[], None] = None, **kwargs) -> Result:
+        """
+        Issues a controller request, re-authenticating once if the session has expired and retrying transient failures
+        (timeouts, connection errors, 429/5xx) with exponential backoff for as long as the cycle's retry budget allows.
+        onAttempt is called before every attempt, e.g. to discard records streamed by an attempt which then failed.
+        """
+        generation = self.sessionGeneration
+        reauthenticated = False
+        attempt = 0
+        self.retryBudget.deposit()
+        while True:
+            reason = None
+            if onAttempt is not None:
+                onAttempt()
+            try:
+                result = await self.send(call, debugString, endpoint, **kwargs)
+            except Exception as e:
+                if not isTransientError(e):
+                    raise
+                reason = "timeout" if isTimeout(e) else "connection"
+                if reason == "timeout":
+                    REQUEST_TIMEOUTS.labels(self.host).inc()
+                logging.debug(f"{self.host} - {debugString} failed with {unwrapError(e)!r}")
+                result = Result([] if kwargs.get("isResponseList", True) else {}, Result.Error(f"{self.host} - {debugString} failed with {reason}"))
+            else:
+                code = result.error.code if result.error is not None else None
+                if code in AUTH_EXPIRED_CODES and not reauthenticated:
+                    logging.info(f"{self.host} - {debugString} failed with an expired session. Re-authenticating.")
+                    reauthenticated = True
+                    login = await self.reauthenticate(generation)
+                    if login.error is None:
+                        continue
+                if code in RETRYABLE_CODES:
+                    reason = str(code)
+
+            if reason is None:
+                return result
+            if attempt >= self.maxRetries:
+                REQUEST_FAILURES.labels(self.host).inc()
+                return result
+            if not self.retryBudget.withdraw():
+                RETRY_BUDGET_EXHAUSTED.labels(self.host).inc()
+                REQUEST_FAILURES.labels(self.host).inc()
+                return result
+
+            attempt += 1
+            delay = backoffDelay(attempt)
+            REQUEST_RETRIES.labels(self.host, reason).inc()
+            logging.debug(f"{self.host} - Retrying {debugString} in {delay:.2f} seconds after {reason} (attempt {attempt}/{self.maxRetries})")
+            await asyncio.sleep(delay)
+
+    async def send(self, call: Callable[[], Awaitable], debugString: str, endpoint: str, **kwargs) -> Result:
+        """
+        Issues a single controller call within the adaptive concurrency limit and the request deadline,
+        and reports its outcome to the limiter
+        """
+
+        async def callAndRead():
+            response = await call()
+            if self.recorder is not None:
+                response = await self.recorder.capture(self.host, response, start)
+            return await self.getResultFromResponse(response, debugString, endpoint, **kwargs)
+
+        inFlight = REQUESTS_IN_FLIGHT.labels(self.host)
+        async with self.limiter:
+            start = time.monotonic()
+            inFlight.inc()
+            try:
+                result = await asyncio.wait_for(callAndRead(), self.requestTimeoutSeconds)
+            except Exception as e:
+                timedOut = isTimeout(e)
+                self.limiter.record(time.monotonic() - start, overloaded=timedOut, error=not timedOut)
+                raise
+            finally:
+                inFlight.dec()
+                REQUEST_DURATION.labels(self.host, endpoint).observe(time.monotonic() - start)
+        code = result.error.code if result.error is not None else None
+        self.limiter.record(time.monotonic() - start, overloaded=code in OVERLOAD_CODES, error=code is not None and code >= 500)
+        return result
 
     async def getApmApplications(self) -> Result:
         debugString = f"Gathering applications"
@@ -114,8 +284,7 @@ class AppDService:
                 logging.warning(f"Filtered out all APM applications from analysis by match rule {self.applicationFilter['apm']}")
                 return Result([], None)
 
-        response = await self.controller.getApmApplications()
-        result = await self.getResultFromResponse(response, debugString)
+        result = await self.request(self.controller.getApmApplications, debugString, "applications")
         # apparently it's possible to have a null application name, the controller converts the null into "null"
         if result.error is None:
             for application in result.data:
@@ -134,8 +303,7 @@ class AppDService:
     async def getApplicationsAllTypes(self) -> Result:
         debugString = f"Gathering all applications"
         logging.debug(f"{self.host} - {debugString}")
-        response = await self.controller.getApplicationsAllTypes()
-        return await self.getResultFromResponse(response, debugString)
+        return await self.request(self.controller.getApplicationsAllTypes, debugString, "applicationsAllTypes")
 
     async def getMetricData(
             self,
@@ -146,19 +314,40 @@ class AppDService:
             duration_in_mins: int = "",
             start_time: int = "",
             end_time: int = 1440,
+            onRecord: Callable[[list[str], float], None] = None,
+            allValues: bool = False,
+            onAttempt: Callable[[], None] = None,
     ) -> Result:
+        """
+        Retrieves metric data. When onRecord is given, the response is streamed instead: onRecord is called with the
+        path segments and first value of every returned metric as they arrive, and the result holds their count.
+        With allValues, onRecord gets the metric's whole list of metricValues, e.g. of data which isn't rolled up.
+        A retried request streams its records again, onAttempt is called before every attempt to discard the earlier ones.
+        """
         debugString = f'Gathering Metrics for:"{metric_path}" on application:{applicationID}'
         logging.debug(f"{self.host} - {debugString}")
-        response = await self.controller.getMetricData(
-            applicationID,
-            metric_path,
-            rollup,
-            time_range_type,
-            duration_in_mins,
-            start_time,
-            end_time,
+        return await self.request(
+            lambda: self.controller.getMetricData(
+                applicationID,
+                metric_path,
+                rollup,
+                time_range_type,
+                duration_in_mins,
+                start_time,
+                end_time,
+            ),
+            debugString,
+            "metricData",
+            onAttempt=onAttempt,
+            streamRecords=onRecord,
+            streamAllValues=allValues,
         )
-        return await self.getResultFromResponse(response, debugString)
+
+    async def getMetricTree(self, applicationID: int, metric_path: str = None) -> Result:
+        """Retrieves the names and types (folder or leaf) of the metric browser entries under a metric path, the root if None"""
+        debugString = f'Browsing metric tree:"{metric_path or ""}" on application:{applicationID}'
+        logging.debug(f"{self.host} - {debugString}")
+        return await self.request(lambda: self.controller.getMetricTree(applicationID, metric_path), debugString, "metrics")
 
     async def getEumApplications(self) -> Result:
         debugString = f"Gathering BRUM Applications"
@@ -169,8 +358,8 @@ class AppDService:
                 logging.warning(f"Filtered out all BRUM applications from analysis by match rule {self.applicationFilter['brum']}")
                 return Result([], None)
 
-        response = await self.controller.getEumApplications(f"Custom_Time_Range.BETWEEN_TIMES.{self.endTime}.{self.startTime}.{self.timeRangeMins}")
-        result = await self.getResultFromResponse(response, debugString)
+        timeRange = self.getCustomTimeRange()
+        result = await self.request(lambda: self.controller.getEumApplications(timeRange), debugString, "eumApplications")
 
         if self.applicationFilter is not None:
             pattern = re.compile(self.applicationFilter["brum"])
@@ -192,8 +381,8 @@ class AppDService:
                 logging.warning(f"Filtered out all MRUM applications from analysis by match rule {self.applicationFilter['mrum']}")
                 return Result([], None)
 
-        response = await self.controller.getMRUMApplications(f"Custom_Time_Range.BETWEEN_TIMES.{self.endTime}.{self.startTime}.{self.timeRangeMins}")
-        result = await self.getResultFromResponse(response, debugString)
+        timeRange = self.getCustomTimeRange()
+        result = await self.request(lambda: self.controller.getMRUMApplications(timeRange), debugString, "mobileApplications")
 
         tempData = result.data.copy()
         result.data.clear()
@@ -214,30 +403,79 @@ class AppDService:
 
         return result
 
+    def getCustomTimeRange(self) -> str:
+        """Time range ending now, recomputed per call since applications are rediscovered over the process lifetime"""
+        endTime = int(round(time.time() * 1000))
+        startTime = endTime - (1 * 60 * self.timeRangeMins * 1000)
+        return f"Custom_Time_Range.BETWEEN_TIMES.{endTime}.{startTime}.{self.timeRangeMins}"
+
     async def close(self):
         logging.debug(f"{self.host} - Closing connection")
         await self.session.close()
 
-    async def getResultFromResponse(self, response, debugString, isResponseJSON=True, isResponseList=True) -> Result:
-        body = (await response.content.read()).decode("ISO-8859-1")
+    async def getResultFromResponse(
+            self, response, debugString, endpoint: str, isResponseJSON=True, isResponseList=True, streamRecords=None, streamAllValues=False
+    ) -> Result:
+        if streamRecords is not None and response.status_code < 400:
+            return await self.getRecordsFromResponse(response, debugString, endpoint, streamRecords, streamAllValues)
+
+        body = await response.content.read()
         self.totalCallsProcessed += 1
+        CONTROLLER_REQUESTS.labels(self.host, endpoint).inc()
+        RESPONSE_BYTES.labels(self.host, endpoint).observe(len(body))
 
         if response.status_code >= 400:
-            msg = f"{self.host} - {debugString} failed with code:{response.status_code} body:{body}"
+            text = body.decode("ISO-8859-1")
+            msg = f"{self.host} - {debugString} failed with code:{response.status_code} body:{text}"
             try:
-                responseJSON = json.loads(body)
+                responseJSON = json.loads(text)
                 if "message" in responseJSON:
                     msg = f"{self.host} - {debugString} failed with code:{response.status_code} body:{responseJSON['message']}"
             except JSONDecodeError:
                 pass
             logging.debug(msg)
-            return Result([] if isResponseList else {}, Result.Error(f"{response.status_code}"))
+            return Result([] if isResponseList else {}, Result.Error(f"{response.status_code}", response.status_code))
         if isResponseJSON:
             try:
-                return Result(json.loads(body), None)
-            except JSONDecodeError:
-                msg = f"{self.host} - {debugString} failed to parse json from body. Returned code:{response.status_code} body:{body}"
+                start = time.perf_counter()
+                data = await JsonUtils.loads(body)
+                RESPONSE_DECODE_DURATION.labels(self.host, endpoint).observe(time.perf_counter() - start)
+                return Result(data, None)
+            except ValueError:
+                msg = f"{self.host} - {debugString} failed to parse json from body. Returned code:{response.status_code} body:{body.decode('ISO-8859-1')}"
                 logging.error(msg)
                 return Result([] if isResponseList else {}, Result.Error(msg))
         else:
-            return Result(body, None)
+            return Result(body.decode("ISO-8859-1"), None)
+
+    async def getRecordsFromResponse(self, response, debugString, endpoint: str, onRecord: Callable, allValues: bool = False) -> Result:
+        """
+        Streams (path segments, value) of every metric with a value in a metric-data response, one record at a time,
+        or (path segments, metricValues) with allValues
+        """
+        self.totalCallsProcessed += 1
+        CONTROLLER_REQUESTS.labels(self.host, endpoint).inc()
+        reader = JsonArrayReader()
+        chunks = response.content.iter_chunked(64 * 1024)
+        count = 0
+        size = 0
+        decodeSeconds = 0
+        try:
+            while True:
+                chunk = await anext(chunks, None)
+                start = time.perf_counter()
+                for record in reader.feed(chunk or b"", final=chunk is None):
+                    if record["metricValues"]:
+                        onRecord(record["metricPath"].split("|"), record["metricValues"] if allValues else record["metricValues"][0]["value"])
+                        count += 1
+                decodeSeconds += time.perf_counter() - start
+                if chunk is None:
+                    break
+                size += len(chunk)
+        except (ValueError, KeyError, TypeError) as e:
+            msg = f"{self.host} - {debugString} failed to parse metric data from body. Returned code:{response.status_code} error:{e}"
+            logging.error(msg)
+            return Result(count, Result.Error(msg))
+        RESPONSE_BYTES.labels(self.host, endpoint).observe(size)
+        RESPONSE_DECODE_DURATION.labels(self.host, endpoint).observe(decodeSeconds)
+        return Result(count, None)
@@ -0,0 +1,127 @@
+import gzip
+import json
+import logging
+import time
+from typing import AsyncIterator, Hashable, Iterable, Iterator
+
+# Query parameters derived from the current time, they never match between a recording and its replay
+VOLATILE_QUERY_PARAMETERS = ("time-range", "start-time", "end-time")
+# Job settings which are secrets or only describe how to reach the controller, they are not archived
+UNARCHIVED_JOB_SETTINGS = ("pwd", "username", "account", "port", "ssl", "verifySsl", "useProxy")
+
+
+class BufferedContent:
+    """Body of a fully read response, read like the aiohttp StreamReader it replaces"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        for i in range(0, len(self.body), n):
+            yield self.body[i: i + n]
+
+
+class BufferedResponse:
+    """Controller response whose body was already read to be recorded"""
+
+    def __init__(self, response, body: bytes):
+        self.status = response.status
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.cookies = response.cookies
+        self.url = response.url
+        self.content = BufferedContent(body)
+
+
+class TrafficRecorder:
+    """
+    Records controller responses to a gzipped JSON lines archive: a header with the mapping file and the job settings,
+    followed by one entry per response with its request, status, body and latency. Session cookies are redacted.
+    Recording stops by itself after the given number of metric cycles.
+    """
+
+    def __init__(self, path: str, mapping_file: str, job: list[dict], cycles: int = 1):
+        self.path = path
+        self.cycles = cycles
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.entries = 0
+        # queries not fetched yet in the current metric cycle
+        self.pending: set[Hashable] = None
+        self.write(
+            {
+                "mappingFile": mapping_file,
+                "job": [{key: value for key, value in controller.items() if key not in UNARCHIVED_JOB_SETTINGS} for controller in job],
+            }
+        )
+
+    @property
+    def closed(self) -> bool:
+        return self.file is None
+
+    def write(self, entry: dict):
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    async def capture(self, host: str, response, startedAt: float) -> BufferedResponse:
+        """Reads and records the response, returning a stand-in which serves the body already read"""
+        body = await response.read()
+        if not self.closed:
+            self.entries += 1
+            self.write(
+                {
+                    "host": host,
+                    "latency": round(time.monotonic() - startedAt, 6),
+                    "method": response.method,
+                    "path": response.url.path,
+                    "query": dict(response.url.query),
+                    "status": response.status,
+                    "contentType": response.content_type,
+                    "cookies": {key: "recorded" for key in response.cookies},
+                    # latin-1 maps every byte to one character, so any body survives the round trip through JSON
+                    "body": body.decode("ISO-8859-1"),
+                }
+            )
+        return BufferedResponse(response, body)
+
+    def completeBatch(self, fetched: Iterable[Hashable], scheduled: Iterable[Hashable]) -> bool:
+        """
+        Counts a batch of metric queries fetched by the scheduler. A metric cycle is complete once every scheduled query
+        was fetched since the previous one, the archive is closed once enough were recorded. Returns whether it closed.
+        """
+        scheduled = set(scheduled)
+        pending = scheduled if self.pending is None else self.pending & scheduled
+        self.pending = pending - set(fetched)
+        if self.pending:
+            return False
+        self.cycles -= 1
+        self.pending = None
+        if self.cycles <= 0:
+            self.close()
+            return True
+        return False
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            self.file = None
+            logging.info(f"Recorded {self.entries} controller responses to {self.path}")
+
+
+def readArchive(path: str) -> tuple[dict, Iterator[dict]]:
+    """Returns the header of a traffic archive and an iterator over its entries"""
+    file = gzip.open(path, "rt", encoding="utf-8")
+    header = json.loads(file.readline())
+
+    def entries():
+        with file:
+            for line in file:
+                yield json.loads(line)
+
+    return header, entries()
+
+
+def requestKey(path: str, query: dict) -> tuple:
+    """Identifies a request across recording and replay"""
+    return path, tuple(sorted((key, value) for key, value in query.items() if key not in VOLATILE_QUERY_PARAMETERS))
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+import click
+
+from AppDMetrics import AppDMetrics
+from metrics.HistoryBackfill import HistoryBackfill
+from util.asyncio_utils import AsyncioUtils
+from util.click_utils import coro
+from util.json_utils import JsonUtils
+from util.logging_utils import init_logging
+
+
+@click.command()
+@click.option("-c", "--concurrent-connections", type=int)
+@click.option("-d", "--debug", is_flag=True)
+@click.option("-j", "--job-file", default="DefaultJob")
+@click.option("-m", "--mapping-file", default="DefaultMapping")
+@click.option("--start", type=click.DateTime(), required=True, help="UTC")
+@click.option("--end", type=click.DateTime(), help="UTC, defaults to now")
+@click.option("--chunk-minutes", type=click.IntRange(min=1), default=60)
+@click.option("-o", "--output-dir", type=click.Path(file_okay=False), default="backfill")
+@coro
+async def main(
+        concurrent_connections: int,
+        debug: bool,
+        job_file: str,
+        mapping_file: str,
+        start: datetime,
+        end: datetime,
+        chunk_minutes: int,
+        output_dir: str,
+):
+    """Exports the history of the mapped metrics as OpenMetrics files, for promtool tsdb create-blocks-from openmetrics"""
+    start = start.replace(tzinfo=timezone.utc)
+    end = end.replace(tzinfo=timezone.utc) if end else datetime.now(timezone.utc)
+    if start >= end:
+        raise click.BadParameter(f"must be before --end {end}", param_hint="--start")
+    output_dir = os.path.abspath(output_dir)
+    init_logging(debug)
+    JsonUtils.init()
+
+    app_metrics = AppDMetrics(concurrent_connections, job_file, mapping_file)
+    controllers = app_metrics.controllers
+    loginResults = await AsyncioUtils.gatherWithConcurrency(*[controller.ensureLoggedIn() for controller in controllers])
+    if any(login.error is not None for login in loginResults):
+        await app_metrics.abortAndCleanup(f"Unable to connect to one or more controllers. Aborting.")
+    inventories = await AsyncioUtils.gatherWithConcurrency(*[app_metrics.discovery.discover(controller) for controller in controllers])
+    if any(inventory is None for inventory in inventories):
+        await app_metrics.abortAndCleanup(f"Unable to discover the applications of one or more controllers. Aborting.")
+
+    logging.info(f"Backfilling {start} to {end} in chunks of {chunk_minutes} minutes to {output_dir}")
+    backfill = HistoryBackfill(controllers, app_metrics.queries, app_metrics.collector.definitions, output_dir, chunk_minutes)
+    await backfill.run(dict(zip(controllers, inventories)), start, end)
+    if backfill.failedChunks:
+        await app_metrics.abortAndCleanup(f"Backfill completed without {backfill.failedChunks} chunks, {backfill.failures} metric requests failed")
+    await app_metrics.abortAndCleanup(f"Backfill complete", error=False)
+
+
+if __name__ == "__main__":
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(main())
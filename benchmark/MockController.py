@@ -0,0 +1,199 @@
+import asyncio
+import json
+import math
+import random
+import zlib
+from dataclasses import dataclass
+
+from aiohttp import web
+
+from AppDMetrics import AppDMetrics
+
+
+@dataclass
+class MockControllerConfig:
+    """Shape and behaviour of a mock controller, every random choice is derived from seed so runs are reproducible"""
+
+    applications: int = 10
+    eumApplications: int = 2
+    mobileApplications: int = 2
+    tiers: int = 5
+    nodes: int = 4
+    # number of values for every other wildcard of the mapping file, e.g. business transactions or backends
+    fanOut: int = 2
+    # metricValues returned per metric, 1 matches rolled up data
+    valuesPerMetric: int = 1
+    # latency of metric-data responses follows a lognormal distribution around latencyMs
+    latencyMs: float = 20
+    latencySigma: float = 0.5
+    # fraction of metric-data requests answered with a 500, or throttled with a 429
+    errorRate: float = 0
+    throttleRate: float = 0
+    seed: int = 0
+
+
+class MetricTree:
+    """Metric browser tree of a mock controller, built by expanding the wildcards of every mapping file row"""
+
+    def __init__(self, mapping_file: str, config: MockControllerConfig):
+        self.root: dict = {}
+        self.matches: dict[str, list[str]] = {}
+        metrics, _ = AppDMetrics.load_mapping(mapping_file)
+        for metric, _ in metrics:
+            names = iter(metric.labels)
+            levels = []
+            for segment in metric.metric_path.split("|"):
+                if segment == "*":
+                    label = next(names)
+                    count = {"tier": config.tiers, "node": config.nodes}.get(label, config.fanOut)
+                    levels.append([f"{label.replace('_', ' ').title()} {i}" for i in range(count)])
+                else:
+                    levels.append([segment])
+            self.insert(self.root, levels)
+
+    def insert(self, node: dict, levels: list[list[str]]):
+        if not levels:
+            return
+        for name in levels[0]:
+            self.insert(node.setdefault(name, {}), levels[1:])
+
+    def children(self, metric_path: str) -> list[dict]:
+        """Returns the folders and leaves directly under a literal metric path, as the metric browser lists them"""
+        node = self.root
+        for segment in metric_path.split("|") if metric_path else []:
+            node = node.get(segment)
+            if node is None:
+                return []
+        return [{"name": name, "type": "folder" if child else "leaf"} for name, child in node.items()]
+
+    def match(self, metric_path: str) -> list[str]:
+        """Returns the full path of every leaf matching the (wildcarded) metric path"""
+        if metric_path not in self.matches:
+            paths = [[]]
+            nodes = [self.root]
+            for segment in metric_path.split("|"):
+                children = [
+                    (path + [name], child)
+                    for path, node in zip(paths, nodes)
+                    for name, child in node.items()
+                    if segment == "*" or name == segment
+                ]
+                paths = [path for path, _ in children]
+                nodes = [child for _, child in children]
+            self.matches[metric_path] = ["|".join(path) for path, node in zip(paths, nodes) if not node]
+        return self.matches[metric_path]
+
+
+class MockController:
+    """
+    Local stand-in for the AppDynamics controller endpoints used by AppdController: login, application discovery, the
+    metric tree and metric data, with a configurable amount of applications, metric fan-out, payload size, latency and errors.
+    """
+
+    def __init__(self, config: MockControllerConfig, mapping_file: str = "DefaultMapping"):
+        self.config = config
+        self.tree = MetricTree(mapping_file, config)
+        self.sessions = 0
+        self.attempts: dict[tuple[str, str], int] = {}
+        self.app = web.Application()
+        self.app.router.add_get("/controller/auth", self.login)
+        self.app.router.add_get("/controller/rest/applications", self.getApmApplications)
+        self.app.router.add_get("/controller/rest/applications/{applicationID}/metric-data", self.getMetricData)
+        self.app.router.add_get("/controller/rest/applications/{applicationID}/metrics", self.getMetricTree)
+        self.app.router.add_get("/controller/restui/applicationManagerUiBean/getApplicationsAllTypes", self.getApplicationsAllTypes)
+        self.app.router.add_get("/controller/restui/eumApplications/getAllEumApplicationsData", self.getEumApplications)
+        self.app.router.add_get("/controller/restui/eumApplications/getAllMobileApplicationsData", self.getMRUMApplications)
+
+    async def login(self, request: web.Request) -> web.Response:
+        self.sessions += 1
+        response = web.Response(text="")
+        response.set_cookie("JSESSIONID", f"session-{self.sessions}")
+        response.set_cookie("X-CSRF-TOKEN", f"token-{self.sessions}")
+        return response
+
+    async def getApmApplications(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            [{"id": i, "name": f"Application {i}", "description": "", "accountGuid": "mock"} for i in range(1, self.config.applications + 1)]
+        )
+
+    async def getApplicationsAllTypes(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "analyticsApplication": {"id": 100001, "name": "Analytics"},
+                "dbMonApplication": {"id": 100002, "name": "Database Monitoring"},
+                "simApplication": {"id": 100003, "name": "Server & Infrastructure Monitoring"},
+            }
+        )
+
+    async def getEumApplications(self, request: web.Request) -> web.Response:
+        return web.json_response([{"id": 200000 + i, "name": f"Browser App {i}"} for i in range(self.config.eumApplications)])
+
+    async def getMRUMApplications(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            [
+                {"appKey": f"MOBILE-{i}", "children": [{"applicationId": 300000 + i, "internalName": f"Mobile App {i}"}]}
+                for i in range(self.config.mobileApplications)
+            ]
+        )
+
+    async def getMetricTree(self, request: web.Request) -> web.Response:
+        return web.json_response(self.tree.children(request.query.get("metric-path", "")))
+
+    async def getMetricData(self, request: web.Request) -> web.Response:
+        applicationID = request.match_info["applicationID"]
+        metric_path = request.query["metric-path"]
+        # seeded by request and attempt rather than arrival order, so concurrency doesn't change the outcome of a run
+        key = (applicationID, metric_path)
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        rng = random.Random(f"{self.config.seed}|{applicationID}|{metric_path}|{self.attempts[key]}")
+
+        await asyncio.sleep(self.config.latencyMs / 1000 * math.exp(self.config.latencySigma * rng.gauss(0, 1)))
+        roll = rng.random()
+        if roll < self.config.errorRate:
+            return web.Response(status=500, text="Internal Server Error")
+        if roll < self.config.errorRate + self.config.throttleRate:
+            return web.Response(status=429, text="Too Many Requests")
+
+        # history which isn't rolled up holds one value per minute of the requested range
+        startMillis, count = 1700000000000, self.config.valuesPerMetric
+        if request.query.get("time-range-type") == "BETWEEN_TIMES" and request.query.get("rollup", "").lower() == "false":
+            startMillis = int(request.query["start-time"])
+            count = max((int(request.query["end-time"]) - startMillis) // 60000, 1)
+
+        paths = self.tree.match(metric_path)
+        if not paths:
+            body = [{"metricName": "METRIC DATA NOT FOUND", "metricId": -1, "metricPath": metric_path, "frequency": "ONE_MIN", "metricValues": []}]
+            return web.json_response(body)
+        body = [
+            {
+                "metricName": path.replace("|", ":"),
+                "metricId": zlib.crc32(path.encode()),
+                "metricPath": path,
+                "frequency": "ONE_MIN",
+                "metricValues": [self.metricValue(path, applicationID, i, startMillis) for i in range(count)],
+            }
+            for path in paths
+        ]
+        return web.Response(body=json.dumps(body).encode(), content_type="application/json")
+
+    @staticmethod
+    def metricValue(path: str, applicationID: str, i: int, startMillis: int = 1700000000000) -> dict:
+        value = zlib.crc32(f"{applicationID}|{path}|{i}".encode()) % 1000
+        return {
+            "startTimeInMillis": startMillis + i * 60000,
+            "occurrences": 0,
+            "current": value,
+            "min": value,
+            "max": value,
+            "useRange": False,
+            "count": 1,
+            "sum": value,
+            "value": value,
+            "standardDeviation": 0,
+        }
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
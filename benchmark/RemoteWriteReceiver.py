@@ -0,0 +1,112 @@
+import random
+import struct
+from typing import Iterator
+
+from aiohttp import web
+
+from util.snappy_utils import decompress
+
+
+def readVarint(data: bytes, i: int) -> tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, i
+
+
+def readFields(data: bytes) -> Iterator[tuple[int, object]]:
+    """Yields the (field number, value) of a protobuf message, bytes for length-delimited fields"""
+    i = 0
+    while i < len(data):
+        key, i = readVarint(data, i)
+        number, wireType = key >> 3, key & 7
+        if wireType == 0:
+            value, i = readVarint(data, i)
+        elif wireType == 1:
+            value, i = data[i: i + 8], i + 8
+        elif wireType == 2:
+            length, i = readVarint(data, i)
+            value, i = data[i: i + length], i + length
+        elif wireType == 5:
+            value, i = data[i: i + 4], i + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wireType}")
+        yield number, value
+
+
+def decodeWriteRequest(data: bytes) -> list[tuple[tuple[tuple[str, str], ...], list[tuple[float, int]]]]:
+    """The (labels, samples) of every TimeSeries of a remote-write WriteRequest, samples as (value, timestamp in ms)"""
+    timeseries = []
+    for number, message in readFields(data):
+        if number != 1:
+            continue
+        labels, samples = [], []
+        for field, value in readFields(message):
+            if field == 1:
+                label = dict(readFields(value))
+                labels.append((label.get(1, b"").decode(), label.get(2, b"").decode()))
+            elif field == 2:
+                sample = dict(readFields(value))
+                samples.append((struct.unpack("<d", sample.get(1, bytes(8)))[0], sample.get(2, 0)))
+        timeseries.append((tuple(labels), samples))
+    return timeseries
+
+
+class RemoteWriteReceiver:
+    """
+    Stand-in for a Prometheus remote-write endpoint, e.g. to benchmark or try out --remote-write-url locally.
+    Decodes every request, keeps the latest sample of each series and reports what it received on /stats.
+    Fails errorRate of the requests with a 500, so they are retried, and rejects malformed ones with a 400.
+    """
+
+    def __init__(self, errorRate: float = 0, seed: int = 0):
+        self.errorRate = errorRate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.failedRequests = 0
+        self.bytes = 0
+        self.samples = 0
+        self.series: dict[tuple[tuple[str, str], ...], tuple[float, int]] = {}
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post("/api/v1/write", self.write)
+        self.app.router.add_get("/stats", self.getStats)
+        self.app.router.add_get("/series", self.getSeries)
+
+    async def write(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if self.rng.random() < self.errorRate:
+            self.failedRequests += 1
+            return web.Response(status=500, text="Internal Server Error")
+        if request.headers.get("Content-Encoding") != "snappy" or request.content_type != "application/x-protobuf":
+            return web.Response(status=400, text="Expected a snappy compressed protobuf body")
+        try:
+            timeseries = decodeWriteRequest(decompress(body))
+        except (ValueError, IndexError, UnicodeDecodeError, struct.error) as e:
+            return web.Response(status=400, text=f"Malformed WriteRequest: {e}")
+        for labels, samples in timeseries:
+            if list(labels) != sorted(labels) or not any(name == "__name__" for name, _ in labels):
+                return web.Response(status=400, text=f"Labels must be sorted and include __name__: {labels}")
+        self.requests += 1
+        self.bytes += len(body)
+        for labels, samples in timeseries:
+            self.samples += len(samples)
+            self.series[labels] = samples[-1]
+        return web.Response(status=204)
+
+    async def getStats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"requests": self.requests, "failedRequests": self.failedRequests, "bytes": self.bytes, "samples": self.samples, "series": len(self.series)}
+        )
+
+    async def getSeries(self, request: web.Request) -> web.Response:
+        return web.json_response([{"labels": dict(labels), "value": value, "timestamp": timestamp} for labels, (value, timestamp) in self.series.items()])
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
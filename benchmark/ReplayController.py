@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from aiohttp import web
+
+from api.appd.TrafficArchive import readArchive, requestKey
+
+
+class ReplayController:
+    """
+    Serves the responses one controller returned while its traffic was recorded, see TrafficRecorder.
+    Repeated requests are answered with their recorded responses in order, starting over once all were served.
+    Every response is delayed by its recorded latency divided by speed, a speed of 0 answers right away.
+    """
+
+    def __init__(self, archive: str, host: str, speed: float = 1):
+        self.speed = speed
+        self.responses: dict[tuple, list[dict]] = defaultdict(list)
+        self.served: dict[tuple, int] = defaultdict(int)
+        _, entries = readArchive(archive)
+        for entry in entries:
+            if entry["host"] == host:
+                entry["body"] = entry["body"].encode("ISO-8859-1")
+                self.responses[requestKey(entry["path"], entry["query"])].append(entry)
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{path:.*}", self.replay)
+
+    async def replay(self, request: web.Request) -> web.Response:
+        key = requestKey(request.path, dict(request.query))
+        responses = self.responses.get(key)
+        if not responses:
+            logging.warning(f"No recorded response for {request.path_qs}")
+            return web.Response(status=404, text="Not recorded")
+        entry = responses[self.served[key] % len(responses)]
+        self.served[key] += 1
+
+        if self.speed > 0:
+            await asyncio.sleep(entry["latency"] / self.speed)
+        response = web.Response(status=entry["status"], body=entry["body"], content_type=entry["contentType"])
+        for cookie in entry["cookies"]:
+            response.set_cookie(cookie, f"replayed-{cookie}")
+        return response
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
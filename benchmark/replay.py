@@ -0,0 +1,49 @@
+import logging
+import os
+
+import click
+
+from api.appd.TrafficArchive import readArchive
+from benchmark.ReplayController import ReplayController
+from benchmark.run import benchmark, report, startControllers
+from util.json_utils import JsonUtils
+
+
+@click.command()
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.option("-s", "--speed", type=click.FloatRange(min=0), default=1, help="Replay latencies this many times faster, 0 for no latency")
+@click.option("--cycles", type=click.IntRange(min=1), default=5)
+@click.option("--warmup", type=click.IntRange(min=0), default=1)
+@click.option("-c", "--concurrent-connections", type=int)
+@click.option("-m", "--mapping-file", help="Defaults to the mapping file the archive was recorded with")
+@click.option("-t", "--cycle-deadline-seconds", type=float)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Also write the results as JSON, e.g. to compare runs")
+@click.option("-d", "--debug", is_flag=True)
+def main(
+        archive: str,
+        speed: float,
+        cycles: int,
+        warmup: int,
+        concurrent_connections: int,
+        mapping_file: str,
+        cycle_deadline_seconds: float,
+        output: str,
+        debug: bool,
+):
+    """Measures AppDMetrics.fetch against controller traffic recorded with main.py --record"""
+    archive = os.path.abspath(archive)
+    output = os.path.abspath(output) if output else None
+    os.chdir(os.path.realpath(f"{__file__}/../.."))
+    logging.basicConfig(level=logging.DEBUG if debug else logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s")
+    JsonUtils.init()
+
+    header, _ = readArchive(archive)
+    mapping_file = mapping_file or header["mappingFile"]
+    job = header["job"]
+    server, addresses = startControllers(ReplayController, [(archive, controller["host"], speed) for controller in job])
+    results = benchmark(server, addresses, job, cycles, warmup, concurrent_connections, mapping_file, cycle_deadline_seconds)
+    report(results, output, {"archive": archive, "speed": speed, "hosts": [controller["host"] for controller in job]})
+
+
+if __name__ == "__main__":
+    main()
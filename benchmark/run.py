@@ -0,0 +1,279 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import time
+from dataclasses import asdict
+
+import aiohttp
+import click
+
+from AppDMetrics import AppDMetrics
+from benchmark.MockController import MockController, MockControllerConfig
+from benchmark.RemoteWriteReceiver import RemoteWriteReceiver
+from metrics.RemoteWriter import RemoteWriter
+from util.json_utils import JsonUtils
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+JOB_FILE = "BenchmarkJob"
+
+
+def serveControllers(controllerClass: type, args: list[tuple], addresses: list[tuple[str, int]], ready):
+    """Runs stand-in controllers in their own process, so they don't compete with the exporter for its event loop"""
+
+    async def serve():
+        for controllerArgs, (host, port) in zip(args, addresses):
+            await controllerClass(*controllerArgs).start(host, port)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def startControllers(controllerClass: type, args: list[tuple]) -> tuple[multiprocessing.Process, list[tuple[str, int]]]:
+    """Starts one stand-in controller per args, each on its own loopback address so their series don't share the controller label"""
+    addresses = [(f"127.0.0.{i + 1}", 0) for i in range(len(args))]
+    addresses = [(host, freePort(host)) for host, _ in addresses]
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    server = context.Process(target=serveControllers, args=(controllerClass, args, addresses, ready), daemon=True)
+    server.start()
+    if not ready.wait(60):
+        server.terminate()
+        raise click.ClickException("Controllers did not start")
+    return server, addresses
+
+
+def freePort(host: str) -> int:
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def peakRssMiB() -> float:
+    if resource is None:
+        return float("nan")
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / 1024 / 1024 if sys.platform == "darwin" else maxrss / 1024
+
+
+async def sampleLoopLag(samples: list[float], interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0
+
+
+async def runCycles(
+        cycles: int,
+        warmup: int,
+        concurrent_connections: int,
+        mapping_file: str,
+        cycle_deadline_seconds: float,
+        remote_write_url: str = None,
+) -> list[dict]:
+    remote_writer = RemoteWriter(remote_write_url) if remote_write_url else None
+    app_metrics = AppDMetrics(concurrent_connections, JOB_FILE, mapping_file, cycle_deadline_seconds, remote_writer=remote_writer)
+    if remote_writer is not None:
+        remote_writer.start()
+    lagSamples = []
+    sampler = asyncio.create_task(sampleLoopLag(lagSamples))
+    results = []
+    try:
+        for cycle in range(warmup + cycles):
+            calls = sum(controller.totalCallsProcessed for controller in app_metrics.controllers)
+            lagSamples.clear()
+            start = time.perf_counter()
+            await app_metrics.fetch()
+            seconds = time.perf_counter() - start
+            requests = sum(controller.totalCallsProcessed for controller in app_metrics.controllers) - calls
+            # the loop lag of the cycle includes pushing its series, which runs alongside the next cycle otherwise
+            if remote_writer is not None:
+                await remote_writer.drain()
+            pushSeconds = time.perf_counter() - start - seconds
+            if cycle < warmup:
+                continue
+            results.append(
+                {
+                    "seconds": seconds,
+                    "requests": requests,
+                    "requestsPerSecond": requests / seconds,
+                    "series": app_metrics.collector.snapshot.seriesCount,
+                    "loopLagP99Ms": percentile(lagSamples, 0.99) * 1000,
+                    "loopLagMaxMs": max(lagSamples, default=0) * 1000,
+                    **({"pushSeconds": pushSeconds} if remote_writer is not None else {}),
+                }
+            )
+    finally:
+        sampler.cancel()
+        for controller in app_metrics.controllers:
+            await controller.close()
+        if remote_writer is not None:
+            await remote_writer.close()
+    return results
+
+
+async def receiverStats(address: tuple[str, int]) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://{address[0]}:{address[1]}/stats") as response:
+            return await response.json()
+
+
+@click.command()
+@click.option("--controllers", type=click.IntRange(min=1), default=1)
+@click.option("--applications", type=click.IntRange(min=0), default=10)
+@click.option("--eum-applications", type=click.IntRange(min=0), default=2)
+@click.option("--mobile-applications", type=click.IntRange(min=0), default=2)
+@click.option("--tiers", type=click.IntRange(min=1), default=5)
+@click.option("--nodes", type=click.IntRange(min=1), default=4)
+@click.option("--fan-out", type=click.IntRange(min=1), default=2)
+@click.option("--values-per-metric", type=click.IntRange(min=1), default=1)
+@click.option("--latency-ms", type=float, default=20)
+@click.option("--latency-sigma", type=float, default=0.5)
+@click.option("--error-rate", type=click.FloatRange(0, 1), default=0)
+@click.option("--throttle-rate", type=click.FloatRange(0, 1), default=0)
+@click.option("--seed", type=int, default=0)
+@click.option("--cycles", type=click.IntRange(min=1), default=5)
+@click.option("--warmup", type=click.IntRange(min=0), default=1)
+@click.option("-c", "--concurrent-connections", type=int)
+@click.option("-m", "--mapping-file", default="DefaultMapping")
+@click.option("--metric-tree-refresh-minutes", type=click.FloatRange(min=0), default=0, help="Compile request plans from the metric tree, 0 to disable")
+@click.option("-t", "--cycle-deadline-seconds", type=float)
+@click.option("--remote-write", is_flag=True, help="Also push every cycle to a local stand-in remote-write receiver")
+@click.option("--remote-write-error-rate", type=click.FloatRange(0, 1), default=0)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Also write the results as JSON, e.g. to compare runs")
+@click.option("-d", "--debug", is_flag=True)
+def main(
+        controllers: int,
+        applications: int,
+        eum_applications: int,
+        mobile_applications: int,
+        tiers: int,
+        nodes: int,
+        fan_out: int,
+        values_per_metric: int,
+        latency_ms: float,
+        latency_sigma: float,
+        error_rate: float,
+        throttle_rate: float,
+        seed: int,
+        cycles: int,
+        warmup: int,
+        concurrent_connections: int,
+        mapping_file: str,
+        metric_tree_refresh_minutes: float,
+        cycle_deadline_seconds: float,
+        remote_write: bool,
+        remote_write_error_rate: float,
+        output: str,
+        debug: bool,
+):
+    """Measures AppDMetrics.fetch against local mock controllers"""
+    output = os.path.abspath(output) if output else None
+    os.chdir(os.path.realpath(f"{__file__}/../.."))
+    logging.basicConfig(level=logging.DEBUG if debug else logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s")
+    JsonUtils.init()
+    config = MockControllerConfig(
+        applications=applications,
+        eumApplications=eum_applications,
+        mobileApplications=mobile_applications,
+        tiers=tiers,
+        nodes=nodes,
+        fanOut=fan_out,
+        valuesPerMetric=values_per_metric,
+        latencyMs=latency_ms,
+        latencySigma=latency_sigma,
+        errorRate=error_rate,
+        throttleRate=throttle_rate,
+        seed=seed,
+    )
+
+    receiver, remote_write_url = None, None
+    if remote_write:
+        receiver, (receiverAddress,) = startControllers(RemoteWriteReceiver, [(remote_write_error_rate, seed)])
+        remote_write_url = f"http://{receiverAddress[0]}:{receiverAddress[1]}/api/v1/write"
+    server, addresses = startControllers(MockController, [(config, mapping_file)] * controllers)
+    job = [{"metricTreeRefreshMinutes": metric_tree_refresh_minutes} for _ in addresses]
+    settings = {"config": asdict(config), "controllers": controllers, "metricTreeRefreshMinutes": metric_tree_refresh_minutes}
+    try:
+        results = benchmark(server, addresses, job, cycles, warmup, concurrent_connections, mapping_file, cycle_deadline_seconds, remote_write_url)
+        if receiver is not None:
+            settings["remoteWrite"] = {"errorRate": remote_write_error_rate, "received": asyncio.run(receiverStats(receiverAddress))}
+    finally:
+        if receiver is not None:
+            receiver.terminate()
+    report(results, output, settings)
+
+
+def benchmark(
+        server: multiprocessing.Process,
+        addresses: list[tuple[str, int]],
+        job: list[dict],
+        cycles: int,
+        warmup: int,
+        concurrent_connections: int,
+        mapping_file: str,
+        cycle_deadline_seconds: float,
+        remote_write_url: str = None,
+) -> list[dict]:
+    """Runs the cycles against the stand-in controllers at addresses, with any further job settings of each controller"""
+    job = [
+        {**settings, "host": host, "port": port, "ssl": False, "account": "customer1", "username": "benchmark", "pwd": "benchmark", "verifySsl": False}
+        for settings, (host, port) in zip(job, addresses)
+    ]
+    with open(f"input/{JOB_FILE}.json", "w") as f:
+        json.dump(job, f, indent=4)
+    try:
+        return asyncio.run(runCycles(cycles, warmup, concurrent_connections, mapping_file, cycle_deadline_seconds, remote_write_url))
+    finally:
+        os.remove(f"input/{JOB_FILE}.json")
+        server.terminate()
+
+
+def report(results: list[dict], output: str, settings: dict):
+    summary = {
+        "cycleSecondsMedian": statistics.median(result["seconds"] for result in results),
+        "requestsPerSecondMedian": statistics.median(result["requestsPerSecond"] for result in results),
+        "loopLagP99MsMax": max(result["loopLagP99Ms"] for result in results),
+        "loopLagMaxMs": max(result["loopLagMaxMs"] for result in results),
+        "peakRssMiB": peakRssMiB(),
+    }
+
+    click.echo(f"{'cycle':>5} {'seconds':>9} {'requests':>9} {'req/s':>9} {'series':>8} {'lag p99 ms':>11} {'lag max ms':>11}")
+    for i, result in enumerate(results):
+        click.echo(
+            f"{i:>5} {result['seconds']:>9.3f} {result['requests']:>9} {result['requestsPerSecond']:>9.1f} {result['series']:>8} "
+            f"{result['loopLagP99Ms']:>11.1f} {result['loopLagMaxMs']:>11.1f}"
+        )
+    click.echo(
+        f"median cycle {summary['cycleSecondsMedian']:.3f}s, median {summary['requestsPerSecondMedian']:.1f} req/s, "
+        f"loop lag p99 {summary['loopLagP99MsMax']:.1f}ms max {summary['loopLagMaxMs']:.1f}ms, peak RSS {summary['peakRssMiB']:.1f} MiB"
+    )
+    if "remoteWrite" in settings:
+        received = settings["remoteWrite"]["received"]
+        click.echo(
+            f"median push {statistics.median(result['pushSeconds'] for result in results):.3f}s, receiver got {received['requests']} requests "
+            f"({received['failedRequests']} failed on purpose) of {received['bytes']} bytes with {received['samples']} samples of {received['series']} series"
+        )
+    if output:
+        with open(output, "w") as f:
+            json.dump({**settings, "cycles": results, "summary": summary}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
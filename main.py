@@ -1,12 +1,20 @@
 import asyncio
+import os
 import sys
 
 import click
 from prometheus_client import start_http_server, Gauge, Enum
 
 from AppDMetrics import AppDMetrics
+from metrics.RemoteWriter import RemoteWriter
+from metrics.ShardSelector import ShardSelector
+from metrics.SnapshotCollector import CARDINALITY_POLICIES, CardinalityLimits
+from metrics.WorkerPool import WorkerPool
 from util.click_utils import coro
+from util.diagnostics_utils import DiagnosticsServer
+from util.json_utils import JsonUtils
 from util.logging_utils import init_logging
+from util.reload_utils import ReloadTrigger
 
 
 @click.command()
@@ -15,10 +23,101 @@ from util.logging_utils import init_logging
 @click.option("-p", "--port", type=int, default=9877)
 @click.option("-j", "--job-file", default="DefaultJob")
 @click.option("-m", "--mapping-file", default="DefaultMapping")
+@click.option("-t", "--cycle-deadline-seconds", type=float)
+@click.option("--decode-executor", type=click.Choice(["thread", "process"]), default="process", help="Pool parsing large responses which aren't JSON arrays")
+@click.option("--decode-offload-bytes", type=int, default=256 * 1024, help="Larger non metric-data responses are parsed in slices or in the pool")
+@click.option("--shard-index", type=click.IntRange(min=0), default=0)
+@click.option("--shard-count", type=click.IntRange(min=1), default=1)
+@click.option("-w", "--workers", type=click.IntRange(min=0), default=0)
+@click.option("--record", type=click.Path(dir_okay=False))
+@click.option("--record-cycles", type=click.IntRange(min=1), default=1)
+@click.option("--diagnostics-port", type=int)
+@click.option("--max-series-per-metric", type=click.IntRange(min=0))
+@click.option("--max-series", type=click.IntRange(min=0))
+@click.option("--cardinality-policy", type=click.Choice(CARDINALITY_POLICIES), default="drop")
+@click.option("--state-file", type=click.Path(dir_okay=False))
+@click.option("--state-save-seconds", type=click.FloatRange(min=0), default=60)
+@click.option("--reload-check-seconds", type=click.FloatRange(min=0), default=10)
+@click.option("--remote-write-url")
+@click.option("--remote-write-batch-size", type=click.IntRange(min=1), default=2000)
+@click.option("--remote-write-queue-size", type=click.IntRange(min=1), default=5)
+@click.option("--remote-write-concurrency", type=click.IntRange(min=1), default=4)
 @coro
-async def main(concurrent_connections: int, debug: bool, port: int, job_file: str, mapping_file: str):
+async def main(
+        concurrent_connections: int,
+        debug: bool,
+        port: int,
+        job_file: str,
+        mapping_file: str,
+        cycle_deadline_seconds: float,
+        decode_executor: str,
+        decode_offload_bytes: int,
+        shard_index: int,
+        shard_count: int,
+        workers: int,
+        record: str,
+        record_cycles: int,
+        diagnostics_port: int,
+        max_series_per_metric: int,
+        max_series: int,
+        cardinality_policy: str,
+        state_file: str,
+        state_save_seconds: float,
+        reload_check_seconds: float,
+        remote_write_url: str,
+        remote_write_batch_size: int,
+        remote_write_queue_size: int,
+        remote_write_concurrency: int,
+):
+    if shard_index >= shard_count:
+        raise click.BadParameter(f"must be less than --shard-count {shard_count}", param_hint="--shard-index")
+    if record and workers:
+        raise click.BadParameter("can not be combined with --workers", param_hint="--record")
+    if state_file and workers:
+        raise click.BadParameter("can not be combined with --workers", param_hint="--state-file")
+    record = os.path.abspath(record) if record else None
+    state_file = os.path.abspath(state_file) if state_file else None
     init_logging(debug)
-    app_metrics = AppDMetrics(concurrent_connections, job_file, mapping_file)
+    cardinality_limits = CardinalityLimits(max_series_per_metric, max_series, cardinality_policy)
+    if diagnostics_port is not None:
+        await DiagnosticsServer().start(diagnostics_port)
+    remote_writer = None
+    if remote_write_url:
+        remote_writer = RemoteWriter(remote_write_url, remote_write_batch_size, remote_write_queue_size, remote_write_concurrency)
+    if workers:
+        pool = WorkerPool(
+            workers,
+            concurrent_connections,
+            job_file,
+            mapping_file,
+            cycle_deadline_seconds,
+            ShardSelector(shard_index, shard_count),
+            cardinality_limits,
+            debug,
+            decode_executor,
+            decode_offload_bytes,
+            diagnostics_port,
+            remote_writer,
+        )
+        start_http_server(port=port)
+        await pool.run()
+        return
+
+    JsonUtils.init(decode_executor, decode_offload_bytes)
+    app_metrics = AppDMetrics(
+        concurrent_connections,
+        job_file,
+        mapping_file,
+        cycle_deadline_seconds,
+        ShardSelector(shard_index, shard_count),
+        cardinality_limits,
+        record_file=record,
+        record_cycles=record_cycles,
+        state_file=state_file,
+        state_save_seconds=state_save_seconds,
+        reload_trigger=ReloadTrigger([f"input/{job_file}.json", f"input/{mapping_file}.tsv"], reload_check_seconds),
+        remote_writer=remote_writer,
+    )
     start_http_server(port=port)
     await app_metrics.run_metrics_loop()
 
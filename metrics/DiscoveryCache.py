@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from api.appd.AppDService import AppDService
+from metrics.RefreshingCache import RefreshingCache
+
+
+@dataclass
+class ApplicationInventory:
+    apm: list[dict]
+    brum: list[dict]
+    mrum: list[dict]
+    extended: dict
+    refreshedAt: float = field(default_factory=time.time)
+
+    def entities(self, entity_type: str) -> list[dict]:
+        """Returns the applications metrics of the given entity type are queried against"""
+        if entity_type == "APM":
+            return self.apm
+        elif entity_type == "ANALYTICS":
+            return [self.extended["analyticsApplication"]]
+        elif entity_type == "DATABASE":
+            return [self.extended["dbMonApplication"]]
+        elif entity_type == "BRUM":
+            return self.brum
+        elif entity_type == "MRUM":
+            return self.mrum
+        elif entity_type == "SIM":
+            return [self.extended["simApplication"]]
+        logging.error(f"Unknown entity type: {entity_type}")
+        return []
+
+
+class DiscoveryCache(RefreshingCache[AppDService, ApplicationInventory]):
+    """
+    Caches each controller's application inventory independently of the metric cycle.
+    Entries are refreshed in the background once their (jittered) TTL has passed, the metric cycle keeps reading the
+    last good inventory meanwhile, and a failed refresh keeps serving it until the next attempt succeeds.
+    """
+
+    def __init__(self, jitter: float = 0.1, retryMinutes: float = 1):
+        super().__init__(jitter, retryMinutes)
+
+    @property
+    def inventories(self) -> dict[AppDService, ApplicationInventory]:
+        return self.values
+
+    def forget(self, controller: AppDService):
+        """Drops the inventory of a controller removed from the job file"""
+        self.evict(lambda key: key is controller)
+
+    def restore(self, controller: AppDService, inventory: ApplicationInventory):
+        """Uses an inventory saved by a previous run, refreshed once its TTL from when it was discovered has passed"""
+        self.put(controller, inventory, inventory.refreshedAt)
+
+    async def load(self, controller: AppDService) -> Optional[ApplicationInventory]:
+        return await self.discover(controller)
+
+    def ttlSeconds(self, controller: AppDService) -> float:
+        return controller.discoveryRefreshMinutes * 60
+
+    def refreshed(self, controller: AppDService, inventory: ApplicationInventory):
+        logging.info(
+            f"{controller.host} - Discovered {len(inventory.apm)} APM, {len(inventory.brum)} BRUM and {len(inventory.mrum)} MRUM applications"
+        )
+
+    def failed(self, controller: AppDService, error: Optional[Exception]):
+        if error is not None:
+            logging.error(f"{controller.host} - Application discovery failed with {error}")
+        if controller in self.inventories:
+            logging.warning(f"{controller.host} - Keeping application inventory from {time.ctime(self.inventories[controller].refreshedAt)}")
+
+    @staticmethod
+    async def discover(controller: AppDService) -> Optional[ApplicationInventory]:
+        apmApplications, brumApplications, mrumApplications, extendedApplications = await asyncio.gather(
+            controller.getApmApplications(),
+            controller.getEumApplications(),
+            controller.getMRUMApplications(),
+            controller.getApplicationsAllTypes(),
+        )
+        for name, result in [
+            ("APM", apmApplications),
+            ("BRUM", brumApplications),
+            ("MRUM", mrumApplications),
+            ("extended", extendedApplications),
+        ]:
+            if result.error is not None:
+                logging.error(f"{controller.host} - Unable to retrieve {name} applications: {result.error.msg}")
+                return None
+
+        for app in mrumApplications.data:
+            app["id"] = app["applicationId"]
+
+        return ApplicationInventory(apmApplications.data, brumApplications.data, mrumApplications.data, extendedApplications.data)
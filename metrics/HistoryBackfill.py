@@ -0,0 +1,157 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import IO
+
+from api.appd.AppDService import AppDService
+from metrics.DiscoveryCache import ApplicationInventory
+from metrics.QueryPlanner import MetricQuery
+from metrics.SnapshotCollector import MetricDefinition
+from util.asyncio_utils import AsyncioUtils
+
+
+def escapeLabelValue(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class OpenMetricsChunkWriter:
+    """
+    Writes the samples of one backfill chunk as an OpenMetrics text file, for promtool tsdb create-blocks-from openmetrics.
+    Samples arrive interleaved across metric families, so each family is spooled to its own temporary file and the
+    families are concatenated once the chunk is complete, so memory is bounded by a single request however much history is written.
+    Only samples within [start, end) are written, so samples on chunk boundaries are written once.
+    The file only appears once close() is called, a chunk which is discarded instead leaves nothing behind.
+    """
+
+    def __init__(self, path: str, definitions: list[MetricDefinition], startMillis: int, endMillis: int):
+        self.path = path
+        self.definitions = definitions
+        self.startMillis = startMillis
+        self.endMillis = endMillis
+        self.spool = tempfile.TemporaryDirectory(dir=os.path.dirname(path), prefix=".backfill-")
+        self.families: dict[int, IO] = {}
+        self.samples = 0
+
+    def add(self, family: int, labels: tuple[str, ...], metricValues: list[dict]):
+        definition = self.definitions[family]
+        if family not in self.families:
+            self.families[family] = open(os.path.join(self.spool.name, str(family)), "w", encoding="utf-8")
+        series = ",".join(f'{name}="{escapeLabelValue(value)}"' for name, value in zip(definition.labelnames, labels))
+        lines = [
+            f"{definition.name}{{{series}}} {value['value']} {value['startTimeInMillis'] / 1000}\n"
+            for value in metricValues
+            if self.startMillis <= value["startTimeInMillis"] < self.endMillis
+        ]
+        self.families[family].writelines(lines)
+        self.samples += len(lines)
+
+    def close(self):
+        """Writes the chunk file from the spooled families, under a temporary name first so only complete chunks exist"""
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for family, spool in sorted(self.families.items()):
+                spool.close()
+                definition = self.definitions[family]
+                f.write(f"# HELP {definition.name} {definition.documentation}\n")
+                f.write(f"# TYPE {definition.name} gauge\n")
+                with open(spool.name, encoding="utf-8") as samples:
+                    shutil.copyfileobj(samples, f)
+            f.write("# EOF\n")
+        os.replace(temporary, self.path)
+        self.spool.cleanup()
+
+    def discard(self):
+        """Drops the spooled samples without writing the chunk file, so the chunk is fetched again by the next run"""
+        for spool in self.families.values():
+            spool.close()
+        self.spool.cleanup()
+
+
+class HistoryBackfill:
+    """
+    Exports the history of every mapped metric between two times, as it is stored by the controller rather than rolled
+    up, into one OpenMetrics file per chunk of the range. Chunks are fetched one after the other, each fans out over
+    every application and metric query within the concurrency budget of the exporter and of each controller.
+    Chunk files which already exist are skipped, so an interrupted backfill picks up where it stopped, and a chunk is only
+    written if every one of its requests succeeded, so running the backfill again also fills in chunks which failed.
+    """
+
+    def __init__(
+            self,
+            controllers: list[AppDService],
+            queries: list[MetricQuery],
+            definitions: list[MetricDefinition],
+            outputDir: str,
+            chunkMinutes: int = 60,
+    ):
+        self.controllers = controllers
+        self.queries = queries
+        self.definitions = definitions
+        self.outputDir = outputDir
+        self.chunkMinutes = chunkMinutes
+        self.failures = 0
+        self.failedChunks = 0
+
+    async def run(self, inventories: dict[AppDService, ApplicationInventory], start: datetime, end: datetime):
+        os.makedirs(self.outputDir, exist_ok=True)
+        startMillis = int(start.timestamp() * 1000)
+        endMillis = int(end.timestamp() * 1000)
+        chunkMillis = self.chunkMinutes * 60 * 1000
+        for chunkStart in range(startMillis, endMillis, chunkMillis):
+            chunkEnd = min(chunkStart + chunkMillis, endMillis)
+            name = datetime.fromtimestamp(chunkStart / 1000, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+            path = os.path.join(self.outputDir, f"{name}.om")
+            if os.path.exists(path):
+                logging.info(f"Skipping chunk {name}, {path} already exists")
+                continue
+            chunkStartedAt = time.time()
+            failures = self.failures
+            writer = OpenMetricsChunkWriter(path, self.definitions, chunkStart, chunkEnd)
+            await self.fetchChunk(inventories, writer)
+            if self.failures > failures:
+                writer.discard()
+                self.failedChunks += 1
+                logging.error(f"Not writing chunk {name}, {self.failures - failures} of its metric requests failed")
+                continue
+            writer.close()
+            logging.info(f"Wrote {writer.samples} samples of chunk {name} to {path} in {time.time() - chunkStartedAt:.1f} seconds")
+        if self.failedChunks:
+            logging.warning(f"{self.failedChunks} chunks were not written because metric requests failed, run the backfill again to fetch them")
+
+    async def fetchChunk(self, inventories: dict[AppDService, ApplicationInventory], writer: OpenMetricsChunkWriter):
+        requests = [
+            self.fetch(controller, entity, query, writer)
+            for controller, inventory in inventories.items()
+            for query in self.queries
+            for entity in inventory.entities(query.entity_type)
+        ]
+        await AsyncioUtils.gatherWithConcurrency(*requests)
+
+    async def fetch(self, controller: AppDService, entity: dict, query: MetricQuery, writer: OpenMetricsChunkWriter):
+        # values are only written once the request succeeded, a retried request streams them again
+        staged: list[tuple[int, tuple[str, ...], list[dict]]] = []
+
+        def onValues(segments: list[str], metricValues: list[dict]):
+            for _, family, labels in query.route(segments):
+                staged.append((family, (controller.host, entity["name"], *labels), metricValues))
+
+        result = await controller.getMetricData(
+            entity["id"],
+            query.metric_path,
+            rollup=False,
+            time_range_type="BETWEEN_TIMES",
+            start_time=writer.startMillis,
+            end_time=writer.endMillis,
+            onRecord=onValues,
+            allValues=True,
+            onAttempt=staged.clear,
+        )
+        if result.error is not None:
+            self.failures += 1
+            logging.error(f"{controller.host} - Error fetching history of metric query: {query.metric_path} for entity: {entity['name']}")
+            return
+        for family, labels, metricValues in staged:
+            writer.add(family, labels, metricValues)
@@ -0,0 +1,163 @@
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.metrics_core import Metric
+
+# Exporter-internal metrics, served alongside the AppDynamics metrics
+CONCURRENCY_LIMIT = Gauge(
+    "appd_exporter_concurrency_limit",
+    "Current adaptive concurrency limit towards the controller",
+    ["controller"],
+)
+REQUEST_RETRIES = Counter(
+    "appd_exporter_request_retries",
+    "Controller requests retried, by reason (timeout, connection or status code)",
+    ["controller", "reason"],
+)
+REQUEST_TIMEOUTS = Counter(
+    "appd_exporter_request_timeouts",
+    "Controller requests which exceeded their deadline",
+    ["controller"],
+)
+REQUEST_FAILURES = Counter(
+    "appd_exporter_request_failures",
+    "Controller requests which still failed after retrying",
+    ["controller"],
+)
+RETRY_BUDGET_EXHAUSTED = Counter(
+    "appd_exporter_retry_budget_exhausted",
+    "Retries skipped because the controller's retry budget for the cycle was used up",
+    ["controller"],
+)
+DEADLINE_SKIPPED_REQUESTS = Counter(
+    "appd_exporter_deadline_skipped_requests",
+    "Metric requests cancelled at the cycle deadline, their series are carried over from the previous cycle",
+    ["controller"],
+)
+NEGATIVE_CACHE_SKIPPED = Counter(
+    "appd_exporter_negative_cache_skipped_requests",
+    "Metric requests not sent because they kept returning no values or a 4xx response, see negativeCacheMaxMinutes",
+    ["controller"],
+)
+METRIC_TREE_PRUNED_REQUESTS = Counter(
+    "appd_exporter_metric_tree_pruned_requests",
+    "Metric requests not sent because the application's metric tree has no metrics for them, see metricTreeRefreshMinutes",
+    ["controller"],
+)
+METRIC_LAST_REFRESH = Gauge(
+    "appd_exporter_metric_last_refresh_timestamp_seconds",
+    "Oldest successful refresh of the metric across the controller's applications",
+    ["controller", "metric"],
+)
+CONTROLLER_REQUESTS = Counter(
+    "appd_exporter_controller_requests",
+    "Controller responses processed, by endpoint",
+    ["controller", "endpoint"],
+)
+REQUEST_DURATION = Histogram(
+    "appd_exporter_request_duration_seconds",
+    "Time from sending a controller request until its response was read, by endpoint",
+    ["controller", "endpoint"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "appd_exporter_requests_in_flight",
+    "Controller requests currently sent and awaiting their response",
+    ["controller"],
+)
+RESPONSE_BYTES = Histogram(
+    "appd_exporter_response_size_bytes",
+    "Size of controller response bodies, by endpoint",
+    ["controller", "endpoint"],
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864),
+)
+RESPONSE_DECODE_DURATION = Histogram(
+    "appd_exporter_response_decode_duration_seconds",
+    "Time spent parsing controller response bodies, by endpoint",
+    ["controller", "endpoint"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+METRIC_SERIES = Gauge(
+    "appd_exporter_metric_series",
+    "Series published for the metric by the latest metrics cycle",
+    ["metric"],
+)
+CYCLE_PHASE_DURATION = Histogram(
+    "appd_exporter_cycle_phase_duration_seconds",
+    "Duration of the phases of a metrics cycle: login, discovery, metrics and publish",
+    ["phase"],
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+SERIES_DROPPED = Counter(
+    "appd_exporter_series_dropped",
+    "Series not published because they exceeded the cardinality limit of their metric (metric_limit) or in total (global_limit)",
+    ["metric", "reason"],
+)
+RESTORED_SNAPSHOT = Gauge(
+    "appd_exporter_restored_snapshot_timestamp_seconds",
+    "Creation time of the snapshot restored at startup, its series are served until refreshed, 0 if none was restored",
+)
+CONFIG_RELOADS = Counter(
+    "appd_exporter_config_reloads",
+    "Reloads of the job and mapping files, by result (success or failure)",
+    ["result"],
+)
+REMOTE_WRITE_REQUESTS = Counter(
+    "appd_exporter_remote_write_requests",
+    "Remote-write requests sent, by result (success, retry or failure)",
+    ["result"],
+)
+REMOTE_WRITE_SERIES = Counter(
+    "appd_exporter_remote_write_series",
+    "Series pushed to the remote-write endpoint, by result (sent, failed or dropped from the full queue)",
+    ["result"],
+)
+REMOTE_WRITE_QUEUE_LENGTH = Gauge(
+    "appd_exporter_remote_write_queue_length",
+    "Published cycles waiting to be pushed to the remote-write endpoint",
+)
+REMOTE_WRITE_DURATION = Histogram(
+    "appd_exporter_remote_write_duration_seconds",
+    "Time from sending a remote-write request until its response was read",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+EVENT_LOOP_LAG = Histogram(
+    "appd_exporter_event_loop_lag_seconds",
+    "How late the event loop ran a callback scheduled on time, a busy loop delays every request and response",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+INTERNAL_METRICS = (
+    CONCURRENCY_LIMIT,
+    REQUEST_RETRIES,
+    REQUEST_TIMEOUTS,
+    REQUEST_FAILURES,
+    RETRY_BUDGET_EXHAUSTED,
+    DEADLINE_SKIPPED_REQUESTS,
+    NEGATIVE_CACHE_SKIPPED,
+    METRIC_TREE_PRUNED_REQUESTS,
+    METRIC_LAST_REFRESH,
+    CONTROLLER_REQUESTS,
+    REQUEST_DURATION,
+    REQUESTS_IN_FLIGHT,
+    RESPONSE_BYTES,
+    RESPONSE_DECODE_DURATION,
+    METRIC_SERIES,
+    SERIES_DROPPED,
+    CYCLE_PHASE_DURATION,
+    RESTORED_SNAPSHOT,
+    CONFIG_RELOADS,
+    REMOTE_WRITE_REQUESTS,
+    REMOTE_WRITE_SERIES,
+    REMOTE_WRITE_QUEUE_LENGTH,
+    REMOTE_WRITE_DURATION,
+    EVENT_LOOP_LAG,
+)
+# pushed by the process which publishes the merged series, the parent of the workers when running with --workers
+REMOTE_WRITE_METRICS = (REMOTE_WRITE_REQUESTS, REMOTE_WRITE_SERIES, REMOTE_WRITE_QUEUE_LENGTH, REMOTE_WRITE_DURATION)
+
+
+def collectInternalMetrics() -> list[Metric]:
+    """
+    Current samples of every exporter-internal metric, e.g. to ship them from a worker process to its parent.
+    The remote-write metrics are left out, the parent pushes and reports them itself.
+    """
+    return [family for metric in INTERNAL_METRICS if metric not in REMOTE_WRITE_METRICS for family in metric.collect()]
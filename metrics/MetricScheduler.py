@@ -0,0 +1,63 @@
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+# how long to wait before checking again when nothing is scheduled, e.g. with an empty job or mapping file
+IDLE_SECONDS = 60
+
+
+@dataclass(order=True)
+class ScheduledQuery:
+    dueAt: float
+    seq: int
+    controller: Any = field(compare=False)
+    query: Any = field(compare=False)
+    intervalSeconds: float = field(compare=False)
+
+
+class MetricScheduler:
+    """
+    Priority queue of (controller, metric query) pairs keyed by their next due time.
+    Each pair is refreshed on its own interval: the query's refreshIntervalMinutes from the mapping file if set,
+    otherwise the refreshIntervalMinutes of the controller's job entry.
+    """
+
+    def __init__(self):
+        self.heap: list[ScheduledQuery] = []
+        self.counter = itertools.count()
+
+    @staticmethod
+    def intervalSeconds(controller, query) -> float:
+        return (query.refresh_interval_minutes or controller.refreshIntervalMinutes) * 60
+
+    def schedule(self, controller, query, dueAt: float = None):
+        dueAt = time.time() if dueAt is None else dueAt
+        heapq.heappush(self.heap, ScheduledQuery(dueAt, next(self.counter), controller, query, self.intervalSeconds(controller, query)))
+
+    def popDue(self, now: float = None) -> list[ScheduledQuery]:
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0].dueAt <= now:
+            due.append(heapq.heappop(self.heap))
+        return due
+
+    def reschedule(self, items: list[ScheduledQuery], completedAt: float):
+        """Schedules each item one interval after it was due, or right away if the fetch overran that interval"""
+        overrun = [item for item in items if item.dueAt + item.intervalSeconds < completedAt]
+        if overrun:
+            longest = max(completedAt - item.dueAt for item in overrun)
+            logging.warning(f"{len(overrun)} metric queries took longer than their refresh interval. Skipping sleep.")
+            logging.warning(f"Consider increasing their refresh interval to at least {(int(longest) // 60) + 1} minutes")
+        for item in items:
+            item.dueAt = max(item.dueAt + item.intervalSeconds, completedAt)
+            item.seq = next(self.counter)
+            heapq.heappush(self.heap, item)
+
+    def secondsUntilNextDue(self) -> Optional[float]:
+        """Seconds until the next pair is due, None if nothing is scheduled"""
+        if not self.heap:
+            return None
+        return max(self.heap[0].dueAt - time.time(), 0)
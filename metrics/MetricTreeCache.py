@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from api.appd.AppDService import AppDService
+from metrics.QueryPlanner import MetricQuery
+from metrics.RefreshingCache import RefreshingCache
+
+
+@dataclass
+class ApplicationPlan:
+    """Concrete metric path of every query of an application, None for queries the application has no metrics for"""
+
+    paths: dict[MetricQuery, Optional[str]]
+    refreshedAt: float = field(default_factory=time.time)
+
+    @property
+    def pruned(self) -> int:
+        return sum(1 for path in self.paths.values() if path is None)
+
+
+class MetricTreeCache(RefreshingCache[tuple[AppDService, int, str], ApplicationPlan]):
+    """
+    Compiles the metric queries into a request plan per application, from the application's metric browser tree.
+    Queries whose literal segments don't exist in the application's tree are pruned, and wildcards the planner
+    collapsed from several mapping rows are narrowed back to a literal when only one of those rows exists.
+    The tree is walked up to the first wildcard of the mapping rows, whose values vary from cycle to cycle.
+    Plans are compiled in the background, per application and entity type, queries are sent as planned by the mapping
+    file until then, and are recompiled once their (jittered) TTL, the controller's metricTreeRefreshMinutes, has passed.
+    """
+
+    def __init__(self, queries: list[MetricQuery], jitter: float = 0.1, retryMinutes: float = 5):
+        super().__init__(jitter, retryMinutes)
+        self.queries = queries
+
+    def path(self, controller: AppDService, entity: dict, query: MetricQuery) -> Optional[str]:
+        """Returns the metric path to request the query with for the application, None if it has nothing to return"""
+        if controller.metricTreeRefreshMinutes <= 0:
+            return query.metric_path
+        plan = self.peek((controller, entity["id"], query.entity_type), entity)
+        if plan is None or query not in plan.paths:
+            return query.metric_path
+        return plan.paths[query]
+
+    def forget(self, controller: AppDService):
+        """Drops the plans of a controller removed from the job file"""
+        self.evict(lambda key: key[0] is controller)
+
+    async def load(self, key: tuple[AppDService, int, str], entity: dict) -> Optional[ApplicationPlan]:
+        controller, applicationId, entity_type = key
+        return await self.compile(controller, applicationId, [query for query in self.queries if query.entity_type == entity_type])
+
+    def ttlSeconds(self, key: tuple[AppDService, int, str]) -> float:
+        return key[0].metricTreeRefreshMinutes * 60
+
+    def refreshed(self, key: tuple[AppDService, int, str], plan: ApplicationPlan, entity: dict):
+        logging.info(f"{key[0].host} - Compiled metric tree of application {entity['name']}, pruned {plan.pruned} of {len(plan.paths)} metric queries")
+
+    def failed(self, key: tuple[AppDService, int, str], error: Optional[Exception], entity: dict):
+        if error is not None:
+            logging.error(f"{key[0].host} - Metric tree discovery for application {entity['name']} failed with {error}")
+
+    @staticmethod
+    async def compile(controller: AppDService, applicationId: int, queries: list[MetricQuery]) -> Optional[ApplicationPlan]:
+        # each folder is browsed once per compile, however many queries share it
+        listings: dict[tuple[str, ...], asyncio.Future] = {}
+        failed = False
+
+        async def children(prefix: tuple[str, ...]) -> Optional[dict[str, str]]:
+            nonlocal failed
+            if prefix not in listings:
+                listings[prefix] = asyncio.ensure_future(controller.getMetricTree(applicationId, "|".join(prefix) or None))
+            result = await listings[prefix]
+            if result.error is not None:
+                failed = True
+                return None
+            return {child["name"].strip().lower(): child["name"] for child in result.data}
+
+        paths = await asyncio.gather(*[MetricTreeCache.resolve(query, children) for query in queries])
+        if failed:
+            return None
+        return ApplicationPlan(dict(zip(queries, paths)))
+
+    @staticmethod
+    async def resolve(query: MetricQuery, children: Callable[[tuple[str, ...]], Awaitable[Optional[dict[str, str]]]]) -> Optional[str]:
+        """Walks the query's metric path down the application's tree, see MetricTreeCache"""
+        segments = query.metric_path.split("|")
+        routes = set(query.routes)
+        resolved = []
+        for i, segment in enumerate(segments):
+            names = await children(tuple(resolved))
+            if names is None:
+                return query.metric_path
+            if segment != "*":
+                if segment.strip().lower() not in names:
+                    return None
+                resolved.append(segment)
+            elif i in query.route_indices:
+                position = query.route_indices.index(i)
+                routes = {route for route in routes if route[position] in names}
+                candidates = {route[position] for route in routes}
+                if not candidates:
+                    return None
+                if len(candidates) > 1:
+                    return "|".join(resolved + segments[i:])
+                resolved.append(names[candidates.pop()])
+            else:
+                # a wildcard of the mapping rows, e.g. the tiers of the application
+                if not names:
+                    return None
+                return "|".join(resolved + segments[i:])
+        return "|".join(resolved)
@@ -0,0 +1,69 @@
+import random
+import time
+from dataclasses import dataclass
+from typing import Hashable, Optional
+
+from api.Result import Result
+
+# client errors which say nothing about the metric itself: expired sessions are logged back in, throttling is retried
+TRANSIENT_CLIENT_ERRORS = (401, 403, 408, 429)
+
+
+@dataclass
+class NegativeEntry:
+    misses: int
+    retryAt: float
+
+
+class NegativeCache:
+    """
+    Remembers (controller, entity id, metric path) requests which keep returning no values or a 4xx response.
+    After the second miss in a row a request is skipped for one refresh interval, doubling with every further miss
+    up to maxMinutes, lengthened by up to `jitter` of it, after which it is re-probed. The first response with values forgets the request.
+    """
+
+    def __init__(self, jitter: float = 0.1):
+        self.jitter = jitter
+        self.entries: dict[Hashable, NegativeEntry] = {}
+
+    def skip(self, key: Hashable, now: float = None) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and (time.time() if now is None else now) < entry.retryAt
+
+    def record(self, key: Hashable, result: Result, intervalSeconds: float, maxMinutes: float, now: float = None) -> Optional[NegativeEntry]:
+        """
+        Updates the entry of a request from its metric-data result, whose data is the number of metrics with a value.
+        Returns the entry if the request is now backing off.
+        """
+        if self.isMiss(result):
+            entry = self.miss(key, intervalSeconds, maxMinutes, now)
+            return entry if entry is not None and entry.misses > 1 else None
+        if result.error is None:
+            self.entries.pop(key, None)
+        return None
+
+    def miss(self, key: Hashable, intervalSeconds: float, maxMinutes: float, now: float = None) -> Optional[NegativeEntry]:
+        if maxMinutes <= 0:
+            return None
+        now = time.time() if now is None else now
+        entry = self.entries.setdefault(key, NegativeEntry(0, now))
+        entry.misses += 1
+        # 0, 1, 3, 7, ... intervals: a single empty response may be a gap in the data, repeated ones back off
+        backoff = min(intervalSeconds * (2 ** min(entry.misses - 1, 16) - 1), maxMinutes * 60)
+        # jittered upwards only, so a backoff of one interval covers the next cycle rather than half the time
+        entry.retryAt = now + backoff * (1 + random.random() * self.jitter)
+        return entry
+
+    @staticmethod
+    def isMiss(result: Result) -> bool:
+        if result.error is not None:
+            return result.error.code is not None and 400 <= result.error.code < 500 and result.error.code not in TRANSIENT_CLIENT_ERRORS
+        return result.data == 0
+
+    def forget(self, controller: str):
+        """Drops the entries of a controller host removed from the job file"""
+        for key in [key for key in self.entries if key[0] == controller]:
+            del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,92 @@
+import logging
+from collections import defaultdict
+from typing import Any
+
+# Maximum number of trailing literal segments of a mapping row that may be replaced with a wildcard when collapsing
+# rows into a shared query. Keeps collapsed queries from pulling whole metric subtrees back from the controller.
+MAX_COLLAPSED_SEGMENTS = 2
+
+
+class MetricQuery:
+    """
+    A single wildcarded metric-data query covering one or more mapping rows.
+    Every returned metricPath is routed back to the rows it belongs to by the values found at `route_indices`,
+    the positions which are literal in the rows but wildcarded in the query.
+    """
+
+    def __init__(self, entity_type: str, metric_path: str, route_indices: list[int], refresh_interval_minutes: float = None):
+        self.entity_type = entity_type
+        self.metric_path = metric_path
+        self.route_indices = route_indices
+        self.refresh_interval_minutes = refresh_interval_minutes
+        self.segment_count = len(metric_path.split("|"))
+        self.routes: dict[tuple, list[tuple[Any, Any, list[int]]]] = defaultdict(list)
+
+    def add(self, metric, target: Any):
+        segments = metric.metric_path.split("|")
+        key = tuple(segments[index].strip().lower() for index in self.route_indices)
+        self.routes[key].append((metric, target, metric.wildcard_indices))
+
+    @property
+    def signature(self) -> tuple:
+        """Identifies the query across reloads of the mapping file"""
+        return self.entity_type, self.metric_path, self.refresh_interval_minutes
+
+    @property
+    def metrics(self) -> list:
+        return [metric for routes in self.routes.values() for metric, _, _ in routes]
+
+    @property
+    def targets(self) -> list:
+        return [target for routes in self.routes.values() for _, target, _ in routes]
+
+    def route(self, segments: list[str]) -> list[tuple[Any, Any, list[str]]]:
+        """Returns (metric, target, labels) for every mapping row matching the segments of a returned metric path"""
+        if len(segments) != self.segment_count:
+            return []
+        key = tuple(segments[index].strip().lower() for index in self.route_indices)
+        return [
+            (metric, target, [segments[index] for index in wildcard_indices])
+            for metric, target, wildcard_indices in self.routes.get(key, [])
+        ]
+
+
+class QueryPlanner:
+    @staticmethod
+    def plan(metrics: list[tuple[Any, Any]]) -> list[MetricQuery]:
+        """
+        Groups mapping rows into the fewest wildcarded metric paths.
+        Rows of the same entity type, depth and refresh interval which only differ in their trailing literal segments
+        (e.g. Overall Application Performance|*|Calls per Minute and Overall Application Performance|*|Errors per Minute)
+        are fetched with one query (Overall Application Performance|*|*).
+        """
+        groups: dict[tuple, list[tuple[Any, Any]]] = defaultdict(list)
+        for metric, target in metrics:
+            wildcard_indices = tuple(metric.wildcard_indices)
+            key = (metric.entity_type, QueryPlanner.groupKey(metric.metric_path), wildcard_indices, metric.refresh_interval_minutes)
+            groups[key].append((metric, target))
+
+        queries = []
+        for (entity_type, _, wildcard_indices, refresh_interval_minutes), rows in groups.items():
+            paths = [metric.metric_path.split("|") for metric, _ in rows]
+            segments = [column[0] if len(set(column)) == 1 else "*" for column in zip(*paths)]
+            route_indices = [i for i, segment in enumerate(segments) if segment == "*" and i not in wildcard_indices]
+            query = MetricQuery(entity_type, "|".join(segments), route_indices, refresh_interval_minutes)
+            for metric, target in rows:
+                query.add(metric, target)
+            queries.append(query)
+
+        logging.info(f"Planned {len(queries)} metric queries for {len(metrics)} mapping rows")
+        return queries
+
+    @staticmethod
+    def groupKey(metric_path: str) -> str:
+        """Replaces up to MAX_COLLAPSED_SEGMENTS trailing literal segments (never the root) with wildcards"""
+        segments = metric_path.split("|")
+        collapsed = 0
+        for i in range(len(segments) - 1, 0, -1):
+            if segments[i] == "*" or collapsed == MAX_COLLAPSED_SEGMENTS:
+                break
+            segments[i] = "*"
+            collapsed += 1
+        return "|".join(segments)
@@ -0,0 +1,81 @@
+import asyncio
+import random
+import time
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class RefreshingCache(Generic[K, V]):
+    """
+    Values loaded and refreshed in the background once their (jittered) TTL has passed. Readers keep getting the last
+    good value meanwhile, and a failed refresh keeps serving it until an attempt retryMinutes later succeeds.
+    Subclasses load values with load(), which returns None on failure, and give their TTL with ttlSeconds().
+    Any further arguments given to peek() or get() are passed on to load() and the refreshed() and failed() hooks.
+    """
+
+    def __init__(self, jitter: float = 0.1, retryMinutes: float = 1):
+        self.jitter = jitter
+        self.retryMinutes = retryMinutes
+        self.values: dict[K, V] = {}
+        self.nextRefresh: dict[K, float] = {}
+        self.refreshes: dict[K, asyncio.Task] = {}
+
+    def peek(self, key: K, *args) -> Optional[V]:
+        """Returns the cached value, None until it was first loaded, and starts refreshing it if it is due"""
+        if time.time() >= self.nextRefresh.get(key, 0) and key not in self.refreshes:
+            self.refreshes[key] = asyncio.create_task(self.refresh(key, *args))
+        return self.values.get(key)
+
+    async def get(self, key: K, *args) -> Optional[V]:
+        """Like peek, but waits for the value to be loaded if it never was"""
+        value = self.peek(key, *args)
+        if value is None and key in self.refreshes:
+            await asyncio.shield(self.refreshes[key])
+            value = self.values.get(key)
+        return value
+
+    def put(self, key: K, value: V, refreshedAt: float):
+        """Caches a value loaded elsewhere, e.g. by a previous run, refreshed once its TTL from refreshedAt has passed"""
+        self.values[key] = value
+        self.nextRefresh[key] = refreshedAt + self.ttlSeconds(key)
+
+    def evict(self, matches: Callable[[K], bool]):
+        """Drops the matching values and cancels their refreshes"""
+        for key in [key for key in self.refreshes if matches(key)]:
+            self.refreshes.pop(key).cancel()
+        for key in [key for key in self.values if matches(key)]:
+            del self.values[key]
+        for key in [key for key in self.nextRefresh if matches(key)]:
+            del self.nextRefresh[key]
+
+    async def refresh(self, key: K, *args):
+        error = None
+        try:
+            value = await self.load(key, *args)
+        except Exception as e:
+            error = e
+            value = None
+        finally:
+            self.refreshes.pop(key, None)
+
+        if value is None:
+            self.nextRefresh[key] = time.time() + self.retryMinutes * 60
+            self.failed(key, error, *args)
+            return
+        self.values[key] = value
+        self.nextRefresh[key] = time.time() + self.ttlSeconds(key) * (1 + random.uniform(-self.jitter, self.jitter))
+        self.refreshed(key, value, *args)
+
+    async def load(self, key: K, *args) -> Optional[V]:
+        raise NotImplementedError
+
+    def ttlSeconds(self, key: K) -> float:
+        raise NotImplementedError
+
+    def refreshed(self, key: K, value: V, *args):
+        """Called once a value was loaded, e.g. to log it"""
+
+    def failed(self, key: K, error: Optional[Exception], *args):
+        """Called once loading a value failed, with the exception it raised if any"""
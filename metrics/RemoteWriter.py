@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import struct
+import time
+from collections import deque
+from typing import Iterator, Optional
+
+import aiohttp
+
+from metrics.InternalMetrics import REMOTE_WRITE_DURATION, REMOTE_WRITE_QUEUE_LENGTH, REMOTE_WRITE_REQUESTS, REMOTE_WRITE_SERIES
+from metrics.SnapshotCollector import MetricDefinition, SeriesSnapshot
+from util.retry_utils import RETRYABLE_CODES, backoffDelay, isTransientError
+from util.snappy_utils import compress, compressionLibrary, encodeVarint
+
+HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+
+
+def encodeField(tag: int, payload: bytes) -> bytes:
+    """A length-delimited protobuf field, tag being the field number and wire type byte"""
+    return bytes((tag,)) + encodeVarint(len(payload)) + payload
+
+
+def encodeLabel(name: str, value: str) -> bytes:
+    """A Label field of a TimeSeries message"""
+    name, value = name.encode(), value.encode()
+    return encodeField(0x0A, encodeField(0x0A, name) + encodeField(0x12, value))
+
+
+def encodeSample(value: float, timestampMillis: int) -> bytes:
+    """A Sample field of a TimeSeries message"""
+    return encodeField(0x12, b"\x09" + struct.pack("<d", value) + b"\x10" + encodeVarint(timestampMillis))
+
+
+def encodeWriteRequests(snapshot: SeriesSnapshot, definitions: list[MetricDefinition], batchSize: int) -> Iterator[tuple[bytes, int]]:
+    """
+    Encodes the series of a snapshot as snappy compressed remote-write WriteRequest messages of at most batchSize
+    series each, yielding every request body with its number of series. Every series gets one sample, at the time the
+    snapshot was built. The protobuf messages are written by hand, they only need the Label and Sample fields.
+    """
+    timestampMillis = int(snapshot.createdAt * 1000)
+    labels: dict[tuple[str, str], bytes] = {}
+    segments: list[bytes] = []
+    series = 0
+    for definition, columns in zip(definitions, snapshot.families):
+        # labels must be sorted by name, __name__ sorts before the label names of the mapping
+        names = ("__name__", *definition.labelnames)
+        order = sorted(range(len(names)), key=lambda i: names[i])
+        for row, value in columns.rows(snapshot.labelValues):
+            row = (definition.name, *row)
+            fields = []
+            for i in order:
+                key = (names[i], row[i])
+                if key not in labels:
+                    labels[key] = encodeLabel(*key)
+                fields.append(labels[key])
+            fields.append(encodeSample(value, timestampMillis))
+            # labels repeat from series to series, the compressor refers back to their previous occurrence
+            segments.append(b"\x0a" + encodeVarint(sum(len(field) for field in fields)))
+            segments.extend(fields)
+            series += 1
+            if series == batchSize:
+                yield compress(segments), series
+                segments, series = [], 0
+    if series:
+        yield compress(segments), series
+
+
+class RemoteWriter:
+    """
+    Pushes the series of every published snapshot to a Prometheus remote-write endpoint, as batches of at most
+    batchSize series. Snapshots wait in a queue of queueSize snapshots which the metrics loop only appends to, so
+    pushing never holds up a cycle. When the endpoint falls behind the oldest queued snapshot is dropped, its series
+    are superseded by the newer ones anyway. Batches are encoded in a thread, up to `concurrency` of them are sent at
+    once and those failing with a connection error or a retryable status code are retried up to maxRetries times.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            batchSize: int = 2000,
+            queueSize: int = 5,
+            concurrency: int = 4,
+            maxRetries: int = 5,
+            timeoutSeconds: float = 30,
+    ):
+        self.url = url
+        self.batchSize = batchSize
+        self.queueSize = queueSize
+        self.concurrency = concurrency
+        self.maxRetries = maxRetries
+        self.timeoutSeconds = timeoutSeconds
+        self.queue: deque[tuple[SeriesSnapshot, list[MetricDefinition]]] = deque()
+        self.pending = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.sender: Optional[asyncio.Task] = None
+
+    def start(self):
+        timeout = aiohttp.ClientTimeout(total=self.timeoutSeconds)
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency), timeout=timeout)
+        self.sender = asyncio.create_task(self.run())
+        logging.info(f"Pushing series to {self.url} in batches of {self.batchSize}, compressed with {compressionLibrary()} snappy")
+
+    def enqueue(self, snapshot: SeriesSnapshot, definitions: list[MetricDefinition]):
+        if len(self.queue) >= self.queueSize:
+            dropped, _ = self.queue.popleft()
+            REMOTE_WRITE_SERIES.labels("dropped").inc(dropped.seriesCount)
+            logging.warning(f"Remote-write queue is full, dropped the {dropped.seriesCount} series of the oldest queued cycle")
+        self.queue.append((snapshot, definitions))
+        REMOTE_WRITE_QUEUE_LENGTH.set(len(self.queue))
+        self.idle.clear()
+        self.pending.set()
+
+    async def drain(self):
+        """Waits until every queued snapshot was pushed or given up on"""
+        await self.idle.wait()
+
+    async def close(self):
+        if self.sender is not None:
+            self.sender.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    async def run(self):
+        while True:
+            await self.pending.wait()
+            if not self.queue:
+                self.pending.clear()
+                self.idle.set()
+                continue
+            snapshot, definitions = self.queue.popleft()
+            REMOTE_WRITE_QUEUE_LENGTH.set(len(self.queue))
+            try:
+                await self.push(snapshot, definitions)
+            except Exception as e:
+                logging.error(f"Pushing {snapshot.seriesCount} series to {self.url} failed with {e}")
+                REMOTE_WRITE_SERIES.labels("failed").inc(snapshot.seriesCount)
+
+    async def push(self, snapshot: SeriesSnapshot, definitions: list[MetricDefinition]):
+        start = time.time()
+        batches = encodeWriteRequests(snapshot, definitions, self.batchSize)
+        slots = asyncio.Semaphore(self.concurrency)
+        sending = []
+        while True:
+            # encoding takes a while for large snapshots, the next batch is encoded while the previous ones are sent
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            await slots.acquire()
+            task = asyncio.create_task(self.send(*batch))
+            task.add_done_callback(lambda _: slots.release())
+            sending.append((task, batch[1]))
+        errors = [(await task, series) for task, series in sending]
+        failed = sum(series for error, series in errors if error is not None)
+        if failed:
+            error = next(error for error, _ in errors if error is not None)
+            logging.error(f"Pushing {failed} of {snapshot.seriesCount} series to {self.url} failed, e.g. with {error}")
+        else:
+            logging.info(f"Pushed {snapshot.seriesCount} series to {self.url} in {time.time() - start:.2f} seconds")
+
+    async def send(self, payload: bytes, series: int) -> Optional[str]:
+        """Sends a batch, retrying it as needed, returns why it failed or None once it was sent"""
+        for attempt in range(self.maxRetries + 1):
+            status, reason = None, None
+            try:
+                with REMOTE_WRITE_DURATION.time():
+                    async with self.session.post(self.url, data=payload, headers=HEADERS) as response:
+                        status = response.status
+                        reason = (await response.text())[:200] if status >= 300 else None
+            except Exception as e:
+                reason = str(e) or type(e).__name__
+                if not isTransientError(e):
+                    break
+
+            if status is not None and status < 300:
+                REMOTE_WRITE_REQUESTS.labels("success").inc()
+                REMOTE_WRITE_SERIES.labels("sent").inc(series)
+                return None
+            if status is not None and status not in RETRYABLE_CODES:
+                # the endpoint rejected the batch itself, sending it again won't help
+                break
+            if attempt < self.maxRetries:
+                REMOTE_WRITE_REQUESTS.labels("retry").inc()
+                await asyncio.sleep(backoffDelay(attempt + 1))
+
+        REMOTE_WRITE_REQUESTS.labels("failure").inc()
+        REMOTE_WRITE_SERIES.labels("failed").inc(series)
+        return f"{status or 'no response'}: {reason}"
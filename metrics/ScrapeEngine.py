@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from api.Result import Result
+
+
+@dataclass(eq=False)
+class ScrapeRequest:
+    """A single (controller, metric, entity) metric-data request"""
+
+    controller: Any
+    entity: dict
+    metric_path: str
+    target: Any
+    # series routed from the streamed response, committed by the handler once the request succeeded
+    staged: dict = field(default_factory=dict)
+
+
+class ScrapeEngine:
+    """
+    Runs every metric-data request of a cycle off one shared work queue.
+    The queue is split into one lane per controller and each lane is drained by as many workers as that
+    controller's adaptive concurrency limit may grow to, so a slow controller never holds up requests for a fast one.
+    """
+
+    def __init__(self, handler: Callable[[ScrapeRequest, Result], None], router: Callable[[ScrapeRequest, list[str], float], None]):
+        self.handler = handler
+        self.router = router
+        self.lanes: dict[Any, deque[ScrapeRequest]] = {}
+
+    def submit(self, request: ScrapeRequest):
+        self.lanes.setdefault(request.controller, deque()).append(request)
+
+    async def run(self, deadline: float = None) -> list[ScrapeRequest]:
+        """
+        Runs every submitted request. If the deadline (in seconds) passes first, requests still queued or in flight
+        are cancelled and returned, everything completed until then has already been handed to the handler.
+        """
+        lanes, self.lanes = self.lanes, {}
+        stopped = asyncio.Event()
+        inFlight: set[ScrapeRequest] = set()
+        workers = []
+        for controller, lane in lanes.items():
+            workers.extend(
+                asyncio.create_task(self._worker(lane, inFlight, stopped)) for _ in range(min(controller.limiter.maxLimit, len(lane)))
+            )
+        if not workers:
+            return []
+
+        _, pending = await asyncio.wait(workers, timeout=deadline)
+        if not pending:
+            return []
+
+        stopped.set()
+        skipped = list(inFlight)
+        for lane in lanes.values():
+            skipped.extend(lane)
+            lane.clear()
+        for worker in pending:
+            worker.cancel()
+        # a cancellation racing a completing request can be swallowed (e.g. by asyncio.wait_for), such workers
+        # are cancelled again and otherwise left to finish on their own, their results are discarded
+        _, pending = await asyncio.wait(pending, timeout=1)
+        for worker in pending:
+            worker.cancel()
+        return skipped
+
+    async def _worker(self, lane: deque[ScrapeRequest], inFlight: set[ScrapeRequest], stopped: asyncio.Event):
+        while lane and not stopped.is_set():
+            request = lane.popleft()
+            inFlight.add(request)
+            result = await self._execute(request)
+            inFlight.discard(request)
+            if stopped.is_set():
+                return
+            try:
+                self.handler(request, result)
+            except Exception as e:
+                logging.error(f"{request.controller.host} - Failed to process metric data for {request.metric_path}: {e}")
+
+    async def _execute(self, request: ScrapeRequest) -> Result:
+        controller = request.controller
+        try:
+            return await controller.getMetricData(
+                request.entity["id"],
+                request.metric_path,
+                rollup=True,
+                time_range_type="BEFORE_NOW",
+                duration_in_mins=controller.timeRangeMins,
+                onRecord=lambda segments, value: self.router(request, segments, value),
+                # only the records of the attempt which succeeded are committed
+                onAttempt=request.staged.clear,
+            )
+        except Exception as e:
+            return Result([], Result.Error(f"{controller.host} - {e}"))
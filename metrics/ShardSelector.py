@@ -0,0 +1,35 @@
+import hashlib
+
+
+class ShardSelector:
+    """
+    Deterministically assigns (controller, application) pairs to one of shardCount exporter replicas.
+    Uses rendezvous (highest random weight) hashing keyed on controller host and application id: every replica computes
+    the same owner for a pair, and adding a replica only moves the ~1/shardCount of the pairs the new replica now owns.
+    """
+
+    def __init__(self, shardIndex: int = 0, shardCount: int = 1):
+        if shardCount < 1 or not 0 <= shardIndex < shardCount:
+            raise ValueError(f"Shard index {shardIndex} must be between 0 and shard count {shardCount} - 1")
+        self.shardIndex = shardIndex
+        self.shardCount = shardCount
+        self.owners: dict[tuple[str, object], int] = {}
+
+    @staticmethod
+    def weight(shard: int, host: str, applicationId) -> int:
+        # hash() is salted per process, so a stable digest is required for replicas to agree on owners
+        key = f"{shard}|{host.lower()}|{applicationId}".encode()
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+    def owner(self, host: str, applicationId) -> int:
+        key = (host, applicationId)
+        if key not in self.owners:
+            self.owners[key] = max(range(self.shardCount), key=lambda shard: self.weight(shard, host, applicationId))
+        return self.owners[key]
+
+    def owns(self, host: str, applicationId) -> bool:
+        return self.shardCount == 1 or self.owner(host, applicationId) == self.shardIndex
+
+    def select(self, host: str, entities: list[dict]) -> list[dict]:
+        """Returns the entities of a controller which belong to this shard"""
+        return [entity for entity in entities if self.owns(host, entity["id"])]
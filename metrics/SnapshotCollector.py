@@ -0,0 +1,222 @@
+import heapq
+import sys
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+from metrics.InternalMetrics import SERIES_DROPPED
+
+CARDINALITY_POLICIES = ("drop", "topn")
+
+
+@dataclass(frozen=True)
+class MetricDefinition:
+    name: str
+    documentation: str
+    labelnames: tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class CardinalityLimits:
+    """
+    Caps on the series published per metric and in total, None for no cap.
+    With the drop policy the series seen first are kept and further ones are dropped as they are added, so a runaway
+    metric never grows past its limit. With the topn policy the series with the highest values are kept once the cycle
+    is built, and the total is shared between the largest metrics.
+    """
+
+    maxSeriesPerMetric: Optional[int] = None
+    maxSeries: Optional[int] = None
+    policy: str = "drop"
+    # per family overrides of maxSeriesPerMetric, from the mapping file
+    perMetric: tuple[Optional[int], ...] = ()
+
+    def metricLimit(self, family: int) -> Optional[int]:
+        if family < len(self.perMetric) and self.perMetric[family] is not None:
+            return self.perMetric[family]
+        return self.maxSeriesPerMetric
+
+
+@dataclass(frozen=True)
+class SeriesColumns:
+    """All series of one metric family stored column-wise, labels as codes into the snapshot's labelValues"""
+
+    codes: array
+    values: array
+    width: int
+
+    def __len__(self):
+        return len(self.values)
+
+    def rows(self, labelValues: tuple[str, ...]) -> Iterator[tuple[tuple[str, ...], float]]:
+        codes, width = self.codes, self.width
+        for i, value in enumerate(self.values):
+            yield tuple(labelValues[code] for code in codes[i * width: (i + 1) * width]), value
+
+
+@dataclass(frozen=True)
+class SeriesSnapshot:
+    """
+    Immutable set of every series published by one metrics cycle, one SeriesColumns per MetricDefinition.
+    Every distinct label value is stored once in labelValues, so memory scales with the unique labels
+    rather than with series times label length.
+    """
+
+    families: tuple[SeriesColumns, ...]
+    createdAt: float
+    labelValues: tuple[str, ...] = ()
+
+    @staticmethod
+    def empty(definitions: list[MetricDefinition]) -> "SeriesSnapshot":
+        return SeriesSnapshot(tuple(SeriesColumns(array("I"), array("d"), len(definition.labelnames)) for definition in definitions), 0)
+
+    @staticmethod
+    def merge(snapshots: list["SeriesSnapshot"]) -> "SeriesSnapshot":
+        """Concatenates snapshots of the same definitions holding disjoint series, e.g. those of several worker processes"""
+        offsets = []
+        labelValues = []
+        for snapshot in snapshots:
+            offsets.append(len(labelValues))
+            labelValues.extend(snapshot.labelValues)
+        families = []
+        for columns in zip(*(snapshot.families for snapshot in snapshots)):
+            codes = array("I")
+            values = array("d")
+            for offset, column in zip(offsets, columns):
+                codes.extend(code + offset for code in column.codes)
+                values.extend(column.values)
+            families.append(SeriesColumns(codes, values, columns[0].width))
+        return SeriesSnapshot(tuple(families), min(snapshot.createdAt for snapshot in snapshots), tuple(labelValues))
+
+    @property
+    def seriesCount(self) -> int:
+        return sum(len(family) for family in self.families)
+
+
+class SnapshotBuilder:
+    """
+    Collects the series of a single metrics cycle, later writes for the same labels replace earlier ones.
+    Series are grouped by their (controller, application) labels. When built on top of a previous snapshot, its series
+    are kept until the application they were scraped from is refreshed, so cycles refreshing only part of the metrics,
+    or cut short by their deadline, keep publishing the rest.
+    """
+
+    def __init__(self, definitions: list[MetricDefinition], base: SeriesSnapshot = None, limits: CardinalityLimits = None):
+        self.definitions = definitions
+        self.limits = limits or CardinalityLimits()
+        self.series: list[dict[tuple[str, str], dict[tuple[str, ...], float]]] = [{} for _ in definitions]
+        self.counts = [0 for _ in definitions]
+        self.total = 0
+        self.dropped = 0
+        if base is not None:
+            for family, (series, columns) in enumerate(zip(self.series, base.families)):
+                # rows share the label strings of the snapshot, so the previous cycle's series are not copied per label
+                for labels, value in columns.rows(base.labelValues):
+                    series.setdefault(labels[:2], {})[labels] = value
+                self.counts[family] = len(columns)
+            self.total = base.seriesCount
+
+    def add(self, family: int, labels: tuple[str, ...], value: float):
+        group = self.series[family].setdefault(labels[:2], {})
+        if labels not in group:
+            if self.limits.policy == "drop":
+                limit = self.limits.metricLimit(family)
+                if limit is not None and self.counts[family] >= limit:
+                    self.drop(family, "metric_limit")
+                    return
+                if self.limits.maxSeries is not None and self.total >= self.limits.maxSeries:
+                    self.drop(family, "global_limit")
+                    return
+            labels = tuple(sys.intern(label) for label in labels)
+            self.counts[family] += 1
+            self.total += 1
+        group[labels] = value
+
+    def drop(self, family: int, reason: str, count: int = 1):
+        self.dropped += count
+        SERIES_DROPPED.labels(self.definitions[family].name, reason).inc(count)
+
+    def clear(self, family: int, controller: str, application: str):
+        """Drops the series of a family scraped from the given application, ahead of refreshing them"""
+        group = self.series[family].pop((controller, application), None)
+        if group:
+            self.counts[family] -= len(group)
+            self.total -= len(group)
+
+    def retain(self, family: int, controller: str, applications: set[str]):
+        """Drops the series of a family scraped from applications of the controller which no longer exist"""
+        series = self.series[family]
+        for key in [key for key in series if key[0] == controller and key[1] not in applications]:
+            self.counts[family] -= len(series[key])
+            self.total -= len(series[key])
+            del series[key]
+
+    def topN(self) -> list[Optional[int]]:
+        """How many series of each family the topn policy keeps, per metric limits first, then the total shared out"""
+        keep = [count if self.limits.metricLimit(family) is None else min(count, self.limits.metricLimit(family)) for family, count in enumerate(self.counts)]
+        if self.limits.maxSeries is not None and sum(keep) > self.limits.maxSeries:
+            # the largest families are cut down to the same size, leaving the smaller ones whole
+            remaining = self.limits.maxSeries
+            families = sorted(range(len(keep)), key=lambda family: keep[family])
+            for i, family in enumerate(families):
+                share = remaining // (len(families) - i)
+                keep[family] = min(keep[family], share)
+                remaining -= keep[family]
+        return keep
+
+    def build(self) -> SeriesSnapshot:
+        keep = self.topN() if self.limits.policy == "topn" else [None] * len(self.series)
+        labelCodes: dict[str, int] = {}
+        families = []
+        for family, (definition, series) in enumerate(zip(self.definitions, self.series)):
+            rows = [(labels, value) for group in series.values() for labels, value in group.items()]
+            if keep[family] is not None and len(rows) > keep[family]:
+                reason = "metric_limit" if keep[family] == self.limits.metricLimit(family) else "global_limit"
+                self.drop(family, reason, len(rows) - keep[family])
+                rows = heapq.nlargest(keep[family], rows, key=lambda row: row[1])
+            codes = array("I", (labelCodes.setdefault(label, len(labelCodes)) for labels, _ in rows for label in labels))
+            values = array("d", (value for _, value in rows))
+            families.append(SeriesColumns(codes, values, len(definition.labelnames)))
+        return SeriesSnapshot(tuple(families), time.time(), tuple(labelCodes))
+
+
+class SnapshotCollector(Collector):
+    """
+    Serves /metrics from the last published SeriesSnapshot.
+    Publishing swaps a single reference, so a scrape never sees a half updated cycle and series missing from the
+    latest cycle are dropped. Metric families are only exposed once they have series.
+    """
+
+    def __init__(self, definitions: list[MetricDefinition]):
+        # definitions and snapshot are swapped together, scrapes run on another thread
+        self.published = (definitions, SeriesSnapshot.empty(definitions))
+
+    @property
+    def definitions(self) -> list[MetricDefinition]:
+        return self.published[0]
+
+    @property
+    def snapshot(self) -> SeriesSnapshot:
+        return self.published[1]
+
+    def publish(self, snapshot: SeriesSnapshot, definitions: list[MetricDefinition] = None):
+        """Publishes a snapshot of the current definitions, or of new definitions once the mapping file was reloaded"""
+        self.published = (definitions or self.definitions, snapshot)
+
+    def describe(self) -> Iterable[GaugeMetricFamily]:
+        for definition in self.definitions:
+            yield GaugeMetricFamily(definition.name, definition.documentation, labels=definition.labelnames)
+
+    def collect(self) -> Iterable[GaugeMetricFamily]:
+        definitions, snapshot = self.published
+        for definition, columns in zip(definitions, snapshot.families):
+            if not columns:
+                continue
+            family = GaugeMetricFamily(definition.name, definition.documentation, labels=definition.labelnames)
+            for labels, value in columns.rows(snapshot.labelValues):
+                family.add_metric(labels, value)
+            yield family
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+import time
+from array import array
+from typing import Optional
+
+from metrics.SnapshotCollector import MetricDefinition, SeriesColumns, SeriesSnapshot
+
+MAGIC = b"APPDSNAP"
+VERSION = 1
+
+
+class SnapshotStore:
+    """
+    Persists the last published SeriesSnapshot to a single binary file, together with the state needed to resume
+    scraping, so a restarted exporter serves the previous series before its first cycle completes.
+    The file holds MAGIC, the length of a JSON header with the metric definitions, label values and state, and then
+    the raw label codes and values arrays of every family. Files are replaced atomically and written from a thread.
+    """
+
+    def __init__(self, path: str, saveIntervalSeconds: float = 60):
+        self.path = path
+        self.saveIntervalSeconds = saveIntervalSeconds
+        self.lastSave = 0
+        self.saving: Optional[asyncio.Task] = None
+
+    def save(self, snapshot: SeriesSnapshot, definitions: list[MetricDefinition], state: dict):
+        """Saves in the background, at most once per saveIntervalSeconds and never twice at once"""
+        if time.time() - self.lastSave < self.saveIntervalSeconds or (self.saving is not None and not self.saving.done()):
+            return
+        self.lastSave = time.time()
+        self.saving = asyncio.create_task(asyncio.to_thread(self.write, snapshot, definitions, state))
+        self.saving.add_done_callback(self.saved)
+
+    def saved(self, task: asyncio.Task):
+        if task.exception() is not None:
+            logging.error(f"Saving snapshot to {self.path} failed with {task.exception()}")
+
+    def write(self, snapshot: SeriesSnapshot, definitions: list[MetricDefinition], state: dict):
+        header = json.dumps(
+            {
+                "version": VERSION,
+                "createdAt": snapshot.createdAt,
+                "byteorder": sys.byteorder,
+                "itemsizes": [array("I").itemsize, array("d").itemsize],
+                "families": [
+                    {"name": definition.name, "labelnames": definition.labelnames, "series": len(columns)}
+                    for definition, columns in zip(definitions, snapshot.families)
+                ],
+                "labelValues": snapshot.labelValues,
+                "state": state,
+            }
+        ).encode()
+        temporary = f"{self.path}.tmp"
+        # the state holds controller sessions, keep the file private to the exporter's user
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            for columns in snapshot.families:
+                columns.codes.tofile(f)
+                columns.values.tofile(f)
+        os.replace(temporary, self.path)
+        logging.debug(f"Saved {snapshot.seriesCount} series to {self.path}")
+
+    def load(self, definitions: list[MetricDefinition]) -> Optional[tuple[SeriesSnapshot, dict]]:
+        """
+        Reads the saved snapshot, laid out for the given definitions: families no longer defined, or whose labels
+        changed, are left out and new ones start empty. Returns None if there is no usable snapshot.
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                data = memoryview(f.read())
+            if bytes(data[:len(MAGIC)]) != MAGIC:
+                raise ValueError("not a snapshot file")
+            (length,) = struct.unpack_from("<I", data, len(MAGIC))
+            offset = len(MAGIC) + 4
+            header = json.loads(bytes(data[offset: offset + length]))
+            offset += length
+            if header["version"] != VERSION or header["itemsizes"] != [array("I").itemsize, array("d").itemsize]:
+                raise ValueError(f"incompatible snapshot version {header['version']}")
+
+            stored = {}
+            for family in header["families"]:
+                codes, values = array("I"), array("d")
+                width = len(family["labelnames"])
+                codes.frombytes(data[offset: offset + family["series"] * width * codes.itemsize])
+                offset += family["series"] * width * codes.itemsize
+                values.frombytes(data[offset: offset + family["series"] * values.itemsize])
+                offset += family["series"] * values.itemsize
+                if header["byteorder"] != sys.byteorder:
+                    codes.byteswap()
+                    values.byteswap()
+                stored[(family["name"], tuple(family["labelnames"]))] = SeriesColumns(codes, values, width)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logging.warning(f"Ignoring snapshot {self.path}: {e}")
+            return None
+
+        families = SeriesSnapshot.empty(definitions).families
+        families = tuple(stored.get((definition.name, definition.labelnames), empty) for definition, empty in zip(definitions, families))
+        return SeriesSnapshot(families, header["createdAt"], tuple(header["labelValues"])), header["state"]
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import sys
+from typing import Iterable
+
+from prometheus_client import REGISTRY
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+
+from AppDMetrics import AppDMetrics
+from metrics.InternalMetrics import INTERNAL_METRICS, REMOTE_WRITE_METRICS, collectInternalMetrics
+from metrics.RemoteWriter import RemoteWriter
+from metrics.ShardSelector import ShardSelector
+from metrics.SnapshotCollector import CardinalityLimits, SeriesSnapshot, SnapshotCollector
+from util.diagnostics_utils import DiagnosticsServer
+from util.json_utils import JsonUtils
+from util.logging_utils import init_logging
+
+
+class WorkerMetricsCollector(Collector):
+    """
+    Serves the exporter-internal metrics last reported by each worker process, merged by metric name.
+    Every sample gets a worker label, so metrics which aren't labelled by controller stay apart per worker.
+    """
+
+    def __init__(self):
+        self.families: dict[int, list[Metric]] = {}
+
+    def collect(self) -> Iterable[Metric]:
+        merged: dict[str, Metric] = {}
+        for workerId, families in list(self.families.items()):
+            for family in families:
+                if family.name not in merged:
+                    merged[family.name] = Metric(family.name, family.documentation, family.type, family.unit)
+                merged[family.name].samples.extend(sample._replace(labels={**sample.labels, "worker": str(workerId)}) for sample in family.samples)
+        return merged.values()
+
+
+class WorkerPool:
+    """
+    Runs the controllers of the job file in worker processes, each with its own event loop, round-robin over at most
+    `workers` processes. Every worker publishes a snapshot of its series after each metrics cycle, the parent serves
+    the merged snapshots of all workers on /metrics, and pushes every worker's snapshot when given a remote_writer.
+    """
+
+    def __init__(
+            self,
+            workers: int,
+            concurrent_connections: int,
+            job_file: str,
+            mapping_file: str,
+            cycle_deadline_seconds: float = None,
+            shard: ShardSelector = None,
+            cardinality_limits: CardinalityLimits = None,
+            debug: bool = False,
+            decode_executor: str = "process",
+            decode_offload_bytes: int = 256 * 1024,
+            diagnostics_port: int = None,
+            remote_writer: RemoteWriter = None,
+    ):
+        # encode passwords once up front, workers then only read the job file
+        job = AppDMetrics.load_job(job_file)
+        definitions = AppDMetrics.compile_mapping(mapping_file).definitions
+        self.groups = [list(range(len(job)))[i::workers] for i in range(min(workers, len(job)))]
+
+        self.collector = SnapshotCollector(definitions)
+        REGISTRY.register(self.collector)
+        # the parent never scrapes, so it only serves the internal metrics of its workers and of its own pushing
+        for metric in INTERNAL_METRICS:
+            if metric not in REMOTE_WRITE_METRICS:
+                REGISTRY.unregister(metric)
+        self.workerMetrics = WorkerMetricsCollector()
+        REGISTRY.register(self.workerMetrics)
+
+        self.remoteWriter = remote_writer
+        self.snapshots: dict[int, SeriesSnapshot] = {}
+        context = multiprocessing.get_context("spawn")
+        self.queue = context.Queue()
+        self.processes = [
+            context.Process(
+                target=runWorker,
+                name=f"appd-worker-{workerId}",
+                args=(
+                    workerId,
+                    group,
+                    self.queue,
+                    (concurrent_connections, job_file, mapping_file, cycle_deadline_seconds, shard, cardinality_limits),
+                    debug,
+                    decode_executor,
+                    decode_offload_bytes,
+                    # the main process serves its diagnostics on diagnostics_port, worker n on the n-th port after it
+                    diagnostics_port + 1 + workerId if diagnostics_port is not None else None,
+                ),
+                daemon=True,
+            )
+            for workerId, group in enumerate(self.groups)
+        ]
+
+    async def run(self):
+        for workerId, process in enumerate(self.processes):
+            process.start()
+            logging.info(f"Started worker {workerId} for controllers {self.groups[workerId]} with pid {process.pid}")
+        if self.remoteWriter is not None:
+            self.remoteWriter.start()
+
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                workerId, snapshot, families = await loop.run_in_executor(None, self.queue.get, True, 1)
+            except queue.Empty:
+                self.checkWorkers()
+                continue
+            self.snapshots[workerId] = snapshot
+            self.workerMetrics.families[workerId] = families
+            self.collector.publish(SeriesSnapshot.merge(list(self.snapshots.values())))
+            if self.remoteWriter is not None:
+                # only the worker's own series, those of the other workers were pushed when they published them
+                self.remoteWriter.enqueue(snapshot, self.collector.definitions)
+            logging.debug(f"Worker {workerId} published {snapshot.seriesCount} series")
+
+    def checkWorkers(self):
+        """A worker only exits when its controllers can not be scraped, which stops the exporter like a single process would"""
+        for workerId, process in enumerate(self.processes):
+            if not process.is_alive():
+                logging.error(f"Worker {workerId} exited with code {process.exitcode}. Aborting.")
+                for other in self.processes:
+                    other.terminate()
+                sys.exit(1)
+
+
+def runWorker(
+        workerId: int,
+        controllerIndices: list[int],
+        snapshots,
+        appDMetricsArgs: tuple,
+        debug: bool,
+        decodeExecutor: str,
+        decodeOffloadBytes: int,
+        diagnosticsPort: int,
+):
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(runWorkerLoop(workerId, controllerIndices, snapshots, appDMetricsArgs, debug, decodeExecutor, decodeOffloadBytes, diagnosticsPort))
+
+
+async def runWorkerLoop(
+        workerId: int,
+        controllerIndices: list[int],
+        snapshots,
+        appDMetricsArgs: tuple,
+        debug: bool,
+        decodeExecutor: str,
+        decodeOffloadBytes: int,
+        diagnosticsPort: int,
+):
+    init_logging(debug)
+    JsonUtils.init(decodeExecutor, decodeOffloadBytes)
+    if diagnosticsPort is not None:
+        await DiagnosticsServer().start(diagnosticsPort)
+    app_metrics = AppDMetrics(
+        *appDMetricsArgs,
+        controller_indices=controllerIndices,
+        # Queue.put pickles and sends from a feeder thread, so publishing never blocks the worker's event loop
+        on_publish=lambda snapshot: snapshots.put((workerId, snapshot, collectInternalMetrics())),
+    )
+    await app_metrics.run_metrics_loop()
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from util.asyncio_utils import AdaptiveLimiter
+
+
+def test_cancelled_woken_waiter_passes_its_slot_on():
+    async def scenario():
+        limiter = AdaptiveLimiter(1)
+        await limiter.acquire()
+        woken = asyncio.create_task(limiter.acquire())
+        next = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        limiter.release()
+        woken.cancel()
+        await asyncio.wait_for(next, 1)
+        assert woken.cancelled()
+        assert limiter.inFlight == 1
+        assert not limiter.waiters
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_queued_waiter_leaves_the_queue():
+    async def scenario():
+        limiter = AdaptiveLimiter(1)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        queued.cancel()
+        await asyncio.sleep(0)
+        assert not limiter.waiters
+        limiter.release()
+        assert limiter.inFlight == 0
+
+    asyncio.run(scenario())
+
+
+def test_woken_waiter_keeps_its_slot_over_newer_callers():
+    async def scenario():
+        limiter = AdaptiveLimiter(1)
+        await limiter.acquire()
+        woken = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+
+        # the newer caller runs in this task, before the woken waiter resumes, and gives up after a while
+        limiter.release()
+        asyncio.get_running_loop().call_later(0.05, asyncio.current_task().cancel)
+        with pytest.raises(asyncio.CancelledError):
+            await limiter.acquire()
+        assert woken.done()
+        assert limiter.inFlight == 1
+        assert not limiter.waiters
+
+    asyncio.run(scenario())
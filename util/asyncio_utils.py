@@ -1,25 +1,37 @@
 import asyncio
 import logging
+import time
+from collections import deque
+from typing import Callable
 
 
 class AsyncioUtils:
     concurrent_connections = 50
+    semaphore: asyncio.Semaphore = None
 
     @staticmethod
     def init(concurrent_connections: int = 50):
+        AsyncioUtils.concurrent_connections = AsyncioUtils.clampConcurrentConnections(concurrent_connections)
+
+    @staticmethod
+    def clampConcurrentConnections(concurrent_connections: int, host: str = None) -> int:
+        prefix = f"{host} - " if host is not None else ""
         if concurrent_connections > 100:
-            logging.warning(f"Concurrent connections ({concurrent_connections}) is too high. Setting to 100.")
+            logging.warning(f"{prefix}Concurrent connections ({concurrent_connections}) is too high. Setting to 100.")
             concurrent_connections = 100
         elif concurrent_connections < 1:
-            logging.warning(f"Concurrent connections ({concurrent_connections}) is too low. Setting to 1.")
+            logging.warning(f"{prefix}Concurrent connections ({concurrent_connections}) is too low. Setting to 1.")
             concurrent_connections = 1
         else:
-            logging.info(f"Setting concurrent connections to {concurrent_connections}.")
-        AsyncioUtils.concurrent_connections = concurrent_connections
+            logging.info(f"{prefix}Setting concurrent connections to {concurrent_connections}.")
+        return concurrent_connections
 
     @staticmethod
     async def gatherWithConcurrency(*tasks):
-        semaphore = asyncio.Semaphore(AsyncioUtils.concurrent_connections)
+        # one long-lived semaphore, so concurrent gathers share the limit instead of each getting their own
+        if AsyncioUtils.semaphore is None:
+            AsyncioUtils.semaphore = asyncio.Semaphore(AsyncioUtils.concurrent_connections)
+        semaphore = AsyncioUtils.semaphore
 
         async def semTask(task):
             async with semaphore:
@@ -30,3 +42,118 @@ class AsyncioUtils:
     @staticmethod
     async def sleep(seconds_to_sleep):
         await asyncio.sleep(seconds_to_sleep)
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter whose limit follows the health of the controller (additive increase, multiplicative decrease).
+    Every window of completed requests grows the limit by one while p95 latency stays within latencyTolerance of the
+    best p95 seen and the error rate stays below errorRateThreshold, and shrinks it otherwise.
+    Overload signals (429, 503, timeouts) halve the limit right away, at most once per round trip so that one burst
+    of rejected in-flight requests only counts once.
+    """
+
+    def __init__(
+            self,
+            initialLimit: int,
+            minLimit: int = 1,
+            maxLimit: int = 100,
+            minWindow: int = 10,
+            latencyTolerance: float = 2.0,
+            errorRateThreshold: float = 0.05,
+            backoffRatio: float = 0.5,
+            onLimitChange: Callable[[int], None] = None,
+    ):
+        self.minLimit = minLimit
+        self.maxLimit = max(maxLimit, minLimit)
+        self.minWindow = minWindow
+        self.latencyTolerance = latencyTolerance
+        self.errorRateThreshold = errorRateThreshold
+        self.backoffRatio = backoffRatio
+        self.onLimitChange = onLimitChange
+
+        self.limit = min(max(initialLimit, self.minLimit), self.maxLimit)
+        self.inFlight = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.baselineLatency: float = None
+        self.lastP95: float = None
+        self.lastBackoff = 0.0
+        if self.onLimitChange is not None:
+            self.onLimitChange(self.limit)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    async def acquire(self):
+        # waiters are handed their slot when woken, so a newer caller can't take it before they resume
+        if self.inFlight < self.limit and not self.waiters:
+            self.inFlight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # cancelled after being handed a slot, pass it on instead of losing it
+                self.release()
+            else:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                self._wakeWaiters()
+            raise
+
+    def release(self):
+        self.inFlight -= 1
+        self._wakeWaiters()
+
+    def _wakeWaiters(self):
+        while self.inFlight < self.limit and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.inFlight += 1
+                waiter.set_result(None)
+
+    def record(self, latency: float, overloaded: bool = False, error: bool = False):
+        """Feeds the outcome of a completed request back into the limit"""
+        if overloaded:
+            if time.monotonic() - self.lastBackoff > (self.lastP95 or 1.0):
+                self._setLimit(int(self.limit * self.backoffRatio))
+                self.lastBackoff = time.monotonic()
+                self.latencies.clear()
+                self.errors = 0
+            return
+
+        self.latencies.append(latency)
+        self.errors += error
+        if len(self.latencies) < max(self.minWindow, self.limit):
+            return
+
+        latencies = sorted(self.latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        errorRate = self.errors / len(latencies)
+        self.lastP95 = p95
+        self.latencies.clear()
+        self.errors = 0
+
+        # let the baseline drift up slowly so a controller which got permanently slower doesn't pin the limit down
+        self.baselineLatency = p95 if self.baselineLatency is None else min(self.baselineLatency * 1.01, p95)
+        if p95 <= self.baselineLatency * self.latencyTolerance and errorRate < self.errorRateThreshold:
+            self._setLimit(self.limit + 1)
+        else:
+            self._setLimit(int(self.limit * 0.9))
+
+    def _setLimit(self, limit: int):
+        limit = min(max(limit, self.minLimit), self.maxLimit)
+        if limit == self.limit:
+            return
+        self.limit = limit
+        if self.onLimitChange is not None:
+            self.onLimitChange(limit)
+        self._wakeWaiters()
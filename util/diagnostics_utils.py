@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+MAX_PROFILE_SECONDS = 60
+
+
+def sampleStacks(threadId: int, seconds: float, interval: float) -> Counter:
+    """
+    Samples the stack of a thread every interval for the given time, from the calling thread.
+    Returns how often each stack was seen, as semicolon separated frames from the outermost one.
+    """
+    stacks = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        frame = sys._current_frames().get(threadId)
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if frames:
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def describeTask(task: asyncio.Task) -> tuple[str, str]:
+    """Returns the coroutine of a task and where it is suspended, plus the controller request it belongs to if any"""
+    coro = task.get_coro()
+    frame = getattr(coro, "cr_frame", None)
+    location = getattr(coro, "__qualname__", repr(coro))
+    request = ""
+    if frame is not None:
+        location = f"{location} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+        obj = frame.f_locals.get("self", None)
+        host = getattr(obj, "host", None)
+        debugString = frame.f_locals.get("debugString", None)
+        if host is not None and debugString is not None:
+            request = f"{host} - {debugString}"
+    return location, request
+
+
+class DiagnosticsServer:
+    """
+    On-demand diagnostics served next to /metrics, nothing is collected until one is requested:
+    - /debug/tasks dumps the pending asyncio tasks, grouped by where they are suspended, and their controller requests
+    - /debug/profile?seconds=10&interval=0.01 samples the event loop thread's stack from another thread and returns the
+      folded stacks, as read by flamegraph.pl or speedscope. The event loop keeps running while it is being profiled.
+    """
+
+    def __init__(self):
+        self.loopThreadId = threading.get_ident()
+        self.profiling = asyncio.Lock()
+        self.app = web.Application()
+        self.app.router.add_get("/debug/tasks", self.tasks)
+        self.app.router.add_get("/debug/profile", self.profile)
+
+    async def tasks(self, request: web.Request) -> web.Response:
+        locations = Counter()
+        requests = []
+        for task in asyncio.all_tasks():
+            location, controllerRequest = describeTask(task)
+            locations[location] += 1
+            if controllerRequest:
+                requests.append(controllerRequest)
+
+        lines = [f"{sum(locations.values())} pending tasks", ""]
+        lines.extend(f"{count:>8} {location}" for location, count in locations.most_common())
+        if requests:
+            lines.extend(["", f"{len(requests)} pending controller requests", ""])
+            lines.extend(sorted(requests))
+        return web.Response(text="\n".join(lines) + "\n")
+
+    async def profile(self, request: web.Request) -> web.Response:
+        try:
+            seconds = min(float(request.query.get("seconds", 10)), MAX_PROFILE_SECONDS)
+            interval = max(float(request.query.get("interval", 0.01)), 0.001)
+        except ValueError:
+            return web.Response(status=400, text="seconds and interval must be numbers\n")
+        if self.profiling.locked():
+            return web.Response(status=409, text="A profile is already being taken\n")
+
+        async with self.profiling:
+            logging.info(f"Profiling the event loop for {seconds} seconds")
+            stacks = await asyncio.to_thread(sampleStacks, self.loopThreadId, seconds, interval)
+        return web.Response(text="".join(f"{stack} {count}\n" for stack, count in stacks.most_common()))
+
+    async def start(self, port: int, host: str = "127.0.0.1") -> web.AppRunner:
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Serving diagnostics on http://{host}:{port}/debug/")
+        return runner
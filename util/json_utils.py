@@ -0,0 +1,120 @@
+import asyncio
+import codecs
+import json
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def decodeInvalidUtf8(error: UnicodeDecodeError) -> tuple[str, int]:
+    """Decodes the bytes of a body which aren't valid UTF-8 as ISO-8859-1, which is what controllers fall back to"""
+    return error.object[error.start:error.end].decode("ISO-8859-1"), error.end
+
+
+# every response body is decoded the same way, whole or streamed: as UTF-8, and bytes which aren't valid UTF-8 as ISO-8859-1
+BODY_ENCODING_ERRORS = "iso-8859-1-fallback"
+codecs.register_error(BODY_ENCODING_ERRORS, decodeInvalidUtf8)
+
+
+def decodeJson(body: bytes):
+    """Parses JSON straight from the response bytes, see BODY_ENCODING_ERRORS for bodies which aren't valid UTF-8"""
+    try:
+        return orjson.loads(body) if orjson is not None else json.loads(body)
+    except ValueError:
+        return json.loads(body.decode("utf-8", BODY_ENCODING_ERRORS))
+
+
+class JsonUtils:
+    executor: Executor = None
+    executorType = "process"
+    offloadThresholdBytes = 256 * 1024
+    # slice of a large array body parsed between two yields to the event loop
+    sliceBytes = 64 * 1024
+
+    @staticmethod
+    def init(executorType: str = "process", offloadThresholdBytes: int = 256 * 1024):
+        JsonUtils.executorType = executorType
+        JsonUtils.offloadThresholdBytes = offloadThresholdBytes
+        logging.info(
+            f"Decoding JSON with {'orjson' if orjson is not None else 'json'}, responses above {offloadThresholdBytes} bytes which aren't "
+            f"streamed are parsed element by element if they are arrays, in a {executorType} pool otherwise."
+        )
+
+    @staticmethod
+    async def loads(body: bytes):
+        """
+        Decodes small bodies inline. Parsers hold the GIL for a whole decode, even in a thread, so large arrays are parsed
+        element by element on the event loop, yielding to it between slices of the body, and other large bodies in the pool.
+        """
+        if len(body) < JsonUtils.offloadThresholdBytes:
+            return decodeJson(body)
+        if body[:JsonUtils.sliceBytes].lstrip()[:1] == b"[":
+            return await JsonUtils.loadsArray(body)
+        if JsonUtils.executor is None:
+            JsonUtils.executor = ProcessPoolExecutor() if JsonUtils.executorType == "process" else ThreadPoolExecutor(thread_name_prefix="json")
+        return await asyncio.get_running_loop().run_in_executor(JsonUtils.executor, decodeJson, body)
+
+    @staticmethod
+    async def loadsArray(body: bytes) -> list:
+        reader = JsonArrayReader()
+        elements = []
+        for start in range(0, len(body), JsonUtils.sliceBytes):
+            end = start + JsonUtils.sliceBytes
+            elements.extend(reader.feed(body[start:end], final=end >= len(body)))
+            await asyncio.sleep(0)
+        return elements
+
+
+class JsonArrayReader:
+    """
+    Incrementally parses the elements of a top level JSON array from chunks of bytes as they arrive.
+    Only the element currently being parsed is held in memory, not the whole document.
+    """
+
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+
+    def __init__(self):
+        self.textDecoder = codecs.getincrementaldecoder("utf-8")(BODY_ENCODING_ERRORS)
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk: bytes, final: bool = False) -> Iterator[Any]:
+        self.buffer += self.textDecoder.decode(chunk, final)
+        pos = 0
+        while not self.finished:
+            while pos < len(self.buffer) and (self.buffer[pos] in self.whitespace or (self.started and self.buffer[pos] == ",")):
+                pos += 1
+            if pos == len(self.buffer):
+                break
+            if not self.started:
+                if self.buffer[pos] != "[":
+                    raise ValueError(f"Expected a JSON array, found {self.buffer[pos:pos + 20]!r}")
+                self.started = True
+                pos += 1
+                continue
+            if self.buffer[pos] == "]":
+                self.finished = True
+                pos += 1
+                break
+            try:
+                element, end = self.decoder.raw_decode(self.buffer, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break
+            # a number at the end of the buffer may still be cut short (e.g. "2." of "2.5"), wait for what follows it
+            complete = end < len(self.buffer) and (self.buffer[pos] in '{["' or self.buffer[end] in self.whitespace + ",]")
+            if not complete and not final:
+                break
+            pos = end
+            yield element
+        self.buffer = self.buffer[pos:]
+        if final and not self.finished:
+            raise ValueError("Unexpected end of JSON array")
@@ -2,6 +2,8 @@ import asyncio
 import logging
 import os
 
+from metrics.InternalMetrics import EVENT_LOOP_LAG
+
 
 def init_logging(debug: bool):
     path = os.path.realpath(f"{__file__}/../..")
@@ -22,7 +24,12 @@ def init_logging(debug: bool):
 
 
 class EventLoopDelayMonitor:
-    def __init__(self, loop=None, start=True, interval=1, logger=None):
+    """
+    Samples how late the event loop runs a callback scheduled `interval` seconds ahead, into a histogram.
+    Each sample is constant work, independent of the number of pending tasks, see DiagnosticsServer for a task dump.
+    """
+
+    def __init__(self, loop=None, start=True, interval=0.25, logger=None):
         self._interval = interval
         self._log = logger or logging.getLogger(__name__)
         self._loop = loop or asyncio.get_event_loop()
@@ -33,26 +40,10 @@ class EventLoopDelayMonitor:
         self._loop.call_later(self._interval, self._handler, self._loop.time())
 
     def _handler(self, start_time):
-        latency = (self._loop.time() - start_time) - self._interval
-
-        self._log.debug(
-            f"asyncio - Task count: {len(asyncio.all_tasks())} - EventLoop delay %.4f",
-            latency,
-        )
-
-        for coro in asyncio.all_tasks():
-            if not hasattr(coro.get_coro(), "cr_frame"):
-                continue
-
-            f_locals = coro.get_coro().cr_frame.f_locals
-
-            obj = f_locals.get("self", None)
-            host = obj.host if hasattr(obj, "host") else None
-
-            debugString = f_locals.get("debugString", None)
-
-            if host is not None and debugString is not None:
-                self._log.debug(f"asyncio PENDING tasks - {host} - {debugString}")
+        latency = max((self._loop.time() - start_time) - self._interval, 0)
+        EVENT_LOOP_LAG.observe(latency)
+        if latency > 0.1:
+            self._log.debug(f"asyncio - EventLoop delay {latency:.4f}")
 
         if not self.is_stopped():
             self.run()
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import os
+import signal
+from typing import Optional
+
+
+class ReloadTrigger:
+    """
+    Signals that the job and mapping files should be reloaded: on SIGHUP, or once a watched file's size or
+    modification time changed, polled every intervalSeconds (0 to only reload on SIGHUP)
+    """
+
+    def __init__(self, paths: list[str], intervalSeconds: float = 10):
+        self.paths = paths
+        self.intervalSeconds = intervalSeconds
+        self.event = asyncio.Event()
+        self.stats = []
+        self.watcher: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.stats = self.stat()
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.trigger, "SIGHUP")
+        if self.intervalSeconds > 0:
+            self.watcher = asyncio.create_task(self.watch())
+
+    def stat(self) -> list[Optional[tuple[int, int]]]:
+        stats = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def trigger(self, reason: str):
+        logging.info(f"Reloading job and mapping files after {reason}")
+        self.event.set()
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.intervalSeconds)
+            if not self.event.is_set() and self.stat() != self.stats:
+                self.trigger("a change to the input files")
+
+    async def wait(self, seconds: float) -> bool:
+        """Sleeps for the given seconds, returns True early if a reload was triggered"""
+        try:
+            await asyncio.wait_for(self.event.wait(), seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def consume(self) -> bool:
+        """Returns whether a reload is pending and resets the trigger, with the files as they are now as the baseline"""
+        pending = self.event.is_set()
+        self.event.clear()
+        self.stats = self.stat()
+        return pending
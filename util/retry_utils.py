@@ -0,0 +1,52 @@
+import asyncio
+import random
+
+import aiohttp
+
+# Status codes worth retrying, the controller is expected to recover from these on its own
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of the requests made in a cycle, so a struggling controller doesn't see its load
+    multiplied by retries. Every first attempt deposits `ratio` tokens, every retry withdraws one.
+    """
+
+    def __init__(self, ratio: float = 0.1, minRetries: int = 10):
+        self.ratio = ratio
+        self.minRetries = minRetries
+        self.tokens = float(minRetries)
+
+    def reset(self):
+        self.tokens = float(self.minRetries)
+
+    def deposit(self):
+        self.tokens += self.ratio
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def backoffDelay(attempt: int, base: float = 0.5, cap: float = 30) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def unwrapError(e: BaseException) -> BaseException:
+    """uplink wraps client errors in ApiError, returns the original error"""
+    while e.args and isinstance(e.args[0], BaseException):
+        e = e.args[0]
+    return e
+
+
+def isTimeout(e: BaseException) -> bool:
+    return isinstance(unwrapError(e), asyncio.TimeoutError)
+
+
+def isTransientError(e: BaseException) -> bool:
+    error = unwrapError(e)
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
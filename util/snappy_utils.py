@@ -0,0 +1,125 @@
+try:
+    import snappy
+except ImportError:
+    snappy = None
+try:
+    import cramjam
+except ImportError:
+    cramjam = None
+
+# longest copy a single snappy copy element can express
+MAX_COPY_LENGTH = 64
+
+
+def encodeVarint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def compressionLibrary() -> str:
+    return "python-snappy" if snappy is not None else "cramjam" if cramjam is not None else "built-in"
+
+
+def compress(segments: list[bytes]) -> bytes:
+    """
+    Compresses the concatenated segments into the snappy block format. Without python-snappy or cramjam, segments
+    seen before are encoded as back-references to their previous occurrence and everything else as literals, which
+    is quick in pure Python and compresses repeated label pairs, the bulk of a remote-write request.
+    """
+    if snappy is not None:
+        return snappy.compress(b"".join(segments))
+    if cramjam is not None:
+        return bytes(cramjam.snappy.compress_raw(b"".join(segments)))
+
+    out = bytearray()
+    literal = bytearray()
+    seen: dict[bytes, int] = {}
+    position = 0
+    for segment in segments:
+        previous = seen.get(segment)
+        seen[segment] = position
+        if previous is None or len(segment) < 4:
+            literal += segment
+            position += len(segment)
+            continue
+        if literal:
+            writeLiteral(out, literal)
+            literal = bytearray()
+        offset = position - previous
+        for start in range(0, len(segment), MAX_COPY_LENGTH):
+            writeCopy(out, offset, min(MAX_COPY_LENGTH, len(segment) - start))
+        position += len(segment)
+    if literal:
+        writeLiteral(out, literal)
+    return encodeVarint(position) + bytes(out)
+
+
+def writeLiteral(out: bytearray, literal: bytes):
+    length = len(literal) - 1
+    if length < 60:
+        out.append(length << 2)
+    else:
+        size = (length.bit_length() + 7) // 8
+        out.append((59 + size) << 2)
+        out += length.to_bytes(size, "little")
+    out += literal
+
+
+def writeCopy(out: bytearray, offset: int, length: int):
+    if offset < 65536:
+        out.append(((length - 1) << 2) | 2)
+        out += offset.to_bytes(2, "little")
+    else:
+        out.append(((length - 1) << 2) | 3)
+        out += offset.to_bytes(4, "little")
+
+
+def decompress(data: bytes) -> bytes:
+    """Decodes the snappy block format, e.g. to check what a remote-write receiver gets"""
+    if snappy is not None:
+        return snappy.uncompress(data)
+    length, shift, i = 0, 0, 0
+    while True:
+        byte = data[i]
+        i += 1
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    out = bytearray()
+    while i < len(data):
+        tag = data[i]
+        i += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = int.from_bytes(data[i: i + extra], "little")
+                i += extra
+            out += data[i: i + size + 1]
+            i += size + 1
+            continue
+        if kind == 1:
+            size = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | data[i]
+            i += 1
+        else:
+            size = (tag >> 2) + 1
+            width = 2 if kind == 2 else 4
+            offset = int.from_bytes(data[i: i + width], "little")
+            i += width
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start: start + size]
+            continue
+        # the copy overlaps the bytes it produces
+        for j in range(size):
+            out.append(out[start + j])
+    if len(out) != length:
+        raise ValueError(f"snappy block decoded to {len(out)} bytes instead of {length}")
+    return bytes(out)